@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from tesla_api import logger
+from tesla_api.sync_worker import run
+
+if __name__ == '__main__':
+    logger.info("SYNC WORKER STARTED")
+    run(once='--once' in sys.argv)
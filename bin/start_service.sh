@@ -12,8 +12,18 @@ fi
 # Start uwsgi
 uwsgi --emperor /etc/uwsgi/emperor.ini &
 
+# Start the TEP synchronization worker, which mirrors the activities in mirror mode
+if [ "$TEP_SYNC_MODE" = "mirror" ]; then
+    python /app/run_sync_worker.py &
+fi
+
 # Initialize Nginx configuration
 envsubst '${INSTRUMENT_PORT}:${SECRET_PREFIX}' < /app/nginx.vh.default.conf > /etc/nginx/conf.d/default.conf
 
+# Do not forward the raw client certificate when the API trusts the identity verified by Nginx
+if [ "$TRUST_PROXY_CERT_HEADERS" -eq 1 ]; then
+    sed -i '/HTTP_X_SSL_CERT /d' /etc/nginx/conf.d/default.conf
+fi
+
 # Start Nginx
 nginx
\ No newline at end of file
@@ -16,7 +16,9 @@
 
 import sys
 import os
+import time
 
+import click
 from click import echo
 
 from tesla_api import app
@@ -71,3 +73,73 @@ def run_https():
 
     #app.run(ssl_context=ctx)
     app.run(ssl_context='adhoc', port=8443, debug=True)
+
+
+@app.cli.command('benchmark_enrolment')
+@click.argument('tesla_id')
+@click.argument('instrument_id', type=int)
+@click.option('--repeat', default=100, help='Number of executions of each implementation.')
+def benchmark_enrolment(tesla_id, instrument_id, repeat):
+    """Compares the enrolment status queries of a learner for an instrument"""
+    from sqlalchemy import event
+    from tesla_api import tesla_db, queries
+
+    def legacy():
+        tesla_db.learners.get_learner_enrolment(tesla_id, instrument_id)
+        tesla_db.learners.count_learner_completed_requests(tesla_id, True, instrument_id)
+        tesla_db.learners.count_learner_pending_requests(tesla_id, True, instrument_id)
+        tesla_db.learners.get_learner_pending_enrolment_requests(tesla_id, instrument_id)
+
+    def aggregate():
+        queries.get_learner_instrument_enrolment_status(tesla_id, instrument_id)
+        tesla_db.learners.get_learner_pending_enrolment_requests(tesla_id, instrument_id)
+
+    statements = [0]
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    engine = tesla_db.db.engine
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    try:
+        echo("{:12s} {:>12s} {:>12s}".format('Query', 'Statements', 'Latency (ms)'))
+        for name, fn in (('legacy', legacy), ('aggregate', aggregate)):
+            fn()
+            tesla_db.db.session.rollback()
+            statements[0] = 0
+            start = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+                tesla_db.db.session.rollback()
+            elapsed = time.perf_counter() - start
+            echo("{:12s} {:12.1f} {:12.3f}".format(name, statements[0] / repeat, elapsed * 1000 / repeat))
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_statement)
+
+
+@app.cli.command('enrolment_counters')
+@click.option('--install', is_flag=True, help='Create the counters table and the trigger maintaining it.')
+def enrolment_counters(install):
+    """Rebuilds the enrolment counters from the requests. Result writes wait until the rebuild ends."""
+    from tesla_api import counters
+
+    if install:
+        counters.install_enrolment_counters()
+        echo('Enrolment counters installed')
+
+    total = counters.rebuild_enrolment_counters()
+    echo('Enrolment counters rebuilt: {}'.format(total))
+
+
+@app.cli.command('activity_reports')
+@click.option('--install', is_flag=True, help='Create the activity reports table and the trigger maintaining it.')
+def activity_reports(install):
+    """Rebuilds the activity reports from the requests"""
+    from tesla_api import activity_reports
+
+    if install:
+        activity_reports.install_activity_reports()
+        echo('Activity reports installed')
+
+    total = activity_reports.rebuild_activity_reports()
+    echo('Activity reports rebuilt: {}'.format(total))
@@ -19,6 +19,10 @@ from tesla_flask import app, logger, tesla_db, cache
 # Define the API Base
 api_base = '/api/v1'
 
+# Report duplicated calls avoided by the request memoization
+from tesla_api.sync import log_avoided_calls
+app.after_request(log_avoided_calls)
+
 # Add learners api
 from tesla_api.api.learners import api_learners
 app.register_blueprint(api_learners, url_prefix=api_base + '/learners')
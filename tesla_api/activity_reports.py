@@ -0,0 +1,483 @@
+"""
+TeSLA materialised activity reports
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from sqlalchemy import text, bindparam
+import tesla_models.schemas as schemas
+from tesla_api import tesla_db, queries, risk
+
+ACTIVITY_REPORTS = bool(int(os.getenv('ACTIVITY_REPORTS', 0)))
+
+LEVEL_CATEGORIES = ('auth', 'content', 'security')
+# Worst level of the learners without any level, so they are sorted after the others
+NO_WORST_LEVEL = 4
+
+# Summary of the results of a learner in an activity for an instrument. Histogram bins use the same binning as the
+# report result bin, floor(value * 10) limited to the last bin.
+REPORT_ROW_SELECT = (
+    "SELECT r.activity_id, r.tesla_id::text, rr.instrument_id, "
+    "SUM(CASE WHEN rr.status = 2 THEN 1 ELSE 0 END), "
+    "SUM(CASE WHEN rr.status = 3 THEN 1 ELSE 0 END), "
+    "SUM(CASE WHEN rr.status IN (0, 1) THEN 1 ELSE 0 END), "
+    "AVG(CASE WHEN rr.status = 2 THEN rr.value END), "
+    "MIN(CASE WHEN rr.status = 2 THEN rr.value END), "
+    "MAX(CASE WHEN rr.status = 2 THEN rr.value END), "
+    "ARRAY[" + ", ".join(
+        "SUM(CASE WHEN rr.status = 2 AND LEAST(GREATEST(CAST(FLOOR(rr.value * 10) AS INTEGER), 0), 9) = {} "
+        "THEN 1 ELSE 0 END)::integer".format(bin_index) for bin_index in range(risk.HISTOGRAM_BINS)) + "], "
+    "txid_current() "
+    "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+    "WHERE NOT r.is_enrolment {filter} "
+    "GROUP BY r.activity_id, r.tesla_id, rr.instrument_id")
+
+REPORT_ROW_COLUMNS = ("activity_id, tesla_id, instrument_id, valid, failed, pending, average, min_value, max_value, "
+                      "bins, revision")
+
+# Results are written by the instruments, so the report rows are maintained by the database itself. Each change of a
+# result computes again the row of its learner and instrument in the activity, marks its level as outdated and
+# increments the results version of the activity. Result writes of the same activity wait for each other to update
+# the version, until they are committed.
+INSTALL_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS activity_results_version ("
+    "activity_id INTEGER PRIMARY KEY, "
+    "version BIGINT NOT NULL)",
+
+    "CREATE TABLE IF NOT EXISTS activity_learner_report ("
+    "activity_id INTEGER NOT NULL, "
+    "tesla_id TEXT NOT NULL, "
+    "instrument_id INTEGER NOT NULL, "
+    "valid INTEGER NOT NULL DEFAULT 0, "
+    "failed INTEGER NOT NULL DEFAULT 0, "
+    "pending INTEGER NOT NULL DEFAULT 0, "
+    "average DOUBLE PRECISION, "
+    "min_value DOUBLE PRECISION, "
+    "max_value DOUBLE PRECISION, "
+    "bins INTEGER[] NOT NULL, "
+    "level INTEGER, "
+    "levels_version TEXT, "
+    "revision BIGINT NOT NULL, "
+    "PRIMARY KEY (activity_id, tesla_id, instrument_id))",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_report_learner "
+    "ON activity_learner_report (tesla_id, instrument_id)",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_report_outdated "
+    "ON activity_learner_report (activity_id, tesla_id) WHERE levels_version IS NULL",
+
+    "CREATE OR REPLACE FUNCTION activity_learner_report_refresh_row(row_activity_id INTEGER, "
+    "row_tesla_id request.tesla_id%TYPE, row_instrument_id INTEGER) RETURNS void AS $$ "
+    "BEGIN "
+    # Serialize the changes of the same row, so each one computes it with the results committed by the others
+    "    PERFORM pg_advisory_xact_lock(hashtext('activity_learner_report:' || row_activity_id || ':' || "
+    "        row_tesla_id::text || ':' || row_instrument_id)); "
+    "    INSERT INTO activity_learner_report (" + REPORT_ROW_COLUMNS + ") " +
+    REPORT_ROW_SELECT.format(filter="AND r.activity_id = row_activity_id AND r.tesla_id = row_tesla_id "
+                                    "AND rr.instrument_id = row_instrument_id") + " "
+    "    ON CONFLICT (activity_id, tesla_id, instrument_id) DO UPDATE SET "
+    "        valid = EXCLUDED.valid, failed = EXCLUDED.failed, pending = EXCLUDED.pending, "
+    "        average = EXCLUDED.average, min_value = EXCLUDED.min_value, max_value = EXCLUDED.max_value, "
+    "        bins = EXCLUDED.bins, level = NULL, levels_version = NULL, revision = EXCLUDED.revision; "
+    "    IF NOT FOUND THEN "
+    "        DELETE FROM activity_learner_report WHERE activity_id = row_activity_id "
+    "        AND tesla_id = row_tesla_id::text AND instrument_id = row_instrument_id; "
+    "        DELETE FROM activity_learner_levels l WHERE l.activity_id = row_activity_id "
+    "        AND l.tesla_id = row_tesla_id::text AND NOT EXISTS (SELECT 1 FROM activity_learner_report a "
+    "        WHERE a.activity_id = l.activity_id AND a.tesla_id = l.tesla_id); "
+    "    END IF; "
+    "    INSERT INTO activity_results_version (activity_id, version) VALUES (row_activity_id, 1) "
+    "    ON CONFLICT (activity_id) DO UPDATE SET version = activity_results_version.version + 1; "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    "CREATE OR REPLACE FUNCTION activity_learner_report_refresh(result_request_id INTEGER, "
+    "result_instrument_id INTEGER) RETURNS void AS $$ "
+    "DECLARE "
+    "    request_activity_id INTEGER; "
+    "    request_tesla_id request.tesla_id%TYPE; "
+    "BEGIN "
+    "    SELECT activity_id, tesla_id INTO request_activity_id, request_tesla_id "
+    "    FROM request WHERE id = result_request_id AND NOT is_enrolment; "
+    "    IF request_activity_id IS NULL THEN "
+    "        RETURN; "
+    "    END IF; "
+    "    PERFORM activity_learner_report_refresh_row(request_activity_id, request_tesla_id, result_instrument_id); "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    # Results deleted by the cascade of a deleted request no longer find it, so the rows of the learner are computed
+    # again when the request is deleted. Results of the request not deleted yet are excluded, since it is gone.
+    "CREATE OR REPLACE FUNCTION activity_learner_report_request_delete() RETURNS trigger AS $$ "
+    "DECLARE "
+    "    report_instrument_id INTEGER; "
+    "BEGIN "
+    "    IF OLD.is_enrolment OR OLD.activity_id IS NULL THEN "
+    "        RETURN NULL; "
+    "    END IF; "
+    "    FOR report_instrument_id IN SELECT instrument_id FROM activity_learner_report "
+    "            WHERE activity_id = OLD.activity_id AND tesla_id = OLD.tesla_id::text LOOP "
+    "        PERFORM activity_learner_report_refresh_row(OLD.activity_id, OLD.tesla_id, report_instrument_id); "
+    "    END LOOP; "
+    "    RETURN NULL; "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    "CREATE OR REPLACE FUNCTION activity_learner_report_update() RETURNS trigger AS $$ "
+    "BEGIN "
+    "    IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+    "        PERFORM activity_learner_report_refresh(OLD.request_id, OLD.instrument_id); "
+    "    END IF; "
+    "    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (NEW.request_id, NEW.instrument_id) IS DISTINCT FROM "
+    "            (OLD.request_id, OLD.instrument_id)) THEN "
+    "        PERFORM activity_learner_report_refresh(NEW.request_id, NEW.instrument_id); "
+    "    END IF; "
+    "    RETURN NULL; "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    # Levels of each learner in the activity, used to filter and sort the reports
+    "CREATE TABLE IF NOT EXISTS activity_learner_levels ("
+    "activity_id INTEGER NOT NULL, "
+    "tesla_id TEXT NOT NULL, "
+    "auth INTEGER NOT NULL, "
+    "content INTEGER NOT NULL, "
+    "security INTEGER NOT NULL, "
+    "worst_level INTEGER NOT NULL, "
+    "PRIMARY KEY (activity_id, tesla_id))",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_levels_worst "
+    "ON activity_learner_levels (activity_id, worst_level, tesla_id)",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_levels_auth ON activity_learner_levels (activity_id, auth, tesla_id)",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_levels_content "
+    "ON activity_learner_levels (activity_id, content, tesla_id)",
+
+    "CREATE INDEX IF NOT EXISTS activity_learner_levels_security "
+    "ON activity_learner_levels (activity_id, security, tesla_id)",
+
+    "DROP TRIGGER IF EXISTS activity_learner_report_update ON request_result",
+
+    "CREATE TRIGGER activity_learner_report_update "
+    "AFTER INSERT OR UPDATE OF status, value, request_id, instrument_id OR DELETE ON request_result "
+    "FOR EACH ROW EXECUTE PROCEDURE activity_learner_report_update()",
+
+    "DROP TRIGGER IF EXISTS activity_learner_report_request_delete ON request",
+
+    "CREATE TRIGGER activity_learner_report_request_delete "
+    "AFTER DELETE ON request "
+    "FOR EACH ROW EXECUTE PROCEDURE activity_learner_report_request_delete()",
+]
+
+REBUILD_STATEMENTS = [
+    # Block result changes while the rows are computed, so no update is lost
+    "LOCK TABLE request_result IN SHARE MODE",
+
+    "DELETE FROM activity_learner_report",
+
+    "DELETE FROM activity_learner_levels",
+
+    "INSERT INTO activity_learner_report (" + REPORT_ROW_COLUMNS + ") " + REPORT_ROW_SELECT.format(filter=""),
+
+    # Contexts cached for the previous versions are not used again
+    "INSERT INTO activity_results_version (activity_id, version) "
+    "SELECT DISTINCT activity_id, 1 FROM activity_learner_report "
+    "ON CONFLICT (activity_id) DO UPDATE SET version = activity_results_version.version + 1",
+]
+
+SUMMARY_QUERY = (
+    "SELECT tesla_id, instrument_id, valid, failed, pending, average, min_value AS min, max_value AS max, level, "
+    "revision "
+    "FROM activity_learner_report "
+    "WHERE activity_id = :activity_id {learner_filter} "
+    "ORDER BY tesla_id, instrument_id")
+
+# Histograms of the learners, adding the bins of all their activities
+HISTOGRAMS_QUERY = (
+    "SELECT h.tesla_id, h.instrument_id, b.bin - 1 AS bin, SUM(b.total) AS total "
+    "FROM activity_learner_report h, unnest(h.bins) WITH ORDINALITY AS b(total, bin) "
+    "WHERE {learner_filter} "
+    "GROUP BY h.tesla_id, h.instrument_id, b.bin")
+
+
+def install_activity_reports():
+    """
+    Create the activity reports table and the trigger maintaining it. Existing rows are kept.
+    """
+    _execute(INSTALL_STATEMENTS)
+
+
+def rebuild_activity_reports():
+    """
+    Compute again all the activity report rows from the requests. Levels are computed again when the reports are
+    requested.
+
+    :return: number of report rows
+    """
+    _execute(REBUILD_STATEMENTS)
+
+    return tesla_db.db.session.execute(text("SELECT COUNT(*) FROM activity_learner_report")).scalar()
+
+
+def get_activity_results_version(activity_id):
+    """
+    Get a version stamp for the results of an activity with a single primary key lookup. The trigger increments the
+    version of the activity each time one of its results is written, by this service or any other. Storing the levels
+    does not change it.
+
+    :param activity_id: activity identifier
+    :return: string with the version of the activity results
+    """
+    version = tesla_db.db.session.execute(text(
+        "SELECT version FROM activity_results_version WHERE activity_id = :activity_id"),
+        {'activity_id': activity_id}).scalar()
+
+    return 'report_{}'.format(version or 0)
+
+
+def get_activity_learners_summary(activity_id, tesla_ids):
+    """
+    Get the results summary of several learners in an activity, for each instrument, from the activity reports table.
+    It has the same format as queries.get_activity_learners_summary.
+
+    :param activity_id: activity identifier
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: dictionary with the list of instrument summaries of each learner, ordered by instrument
+    """
+    summaries = dict((str(tesla_id), []) for tesla_id in tesla_ids)
+    if len(summaries) == 0:
+        return summaries
+
+    rows = tesla_db.db.session.execute(text(
+        SUMMARY_QUERY.format(learner_filter="AND tesla_id IN :tesla_ids")).bindparams(
+        bindparam('tesla_ids', expanding=True)),
+        {'activity_id': activity_id, 'tesla_ids': list(summaries.keys())}).fetchall()
+
+    for row in rows:
+        summaries[row.tesla_id].append(row)
+
+    return summaries
+
+
+def get_learners_valid_results_histograms(tesla_ids, instrument_ids):
+    """
+    Get the histograms of the valid results of several learners for several instruments from the activity reports
+    table. It has the same format as queries.get_learners_valid_results_histograms.
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param instrument_ids: list of instrument identifiers
+    :return: dictionary with the histogram of each (tesla_id, instrument_id)
+    """
+    histograms = dict(((str(tesla_id), instrument_id), [0] * risk.HISTOGRAM_BINS)
+                      for tesla_id in tesla_ids for instrument_id in instrument_ids)
+    if len(histograms) == 0:
+        return histograms
+
+    rows = tesla_db.db.session.execute(text(
+        HISTOGRAMS_QUERY.format(learner_filter="h.tesla_id IN :tesla_ids AND h.instrument_id IN :instrument_ids")
+    ).bindparams(bindparam('tesla_ids', expanding=True), bindparam('instrument_ids', expanding=True)),
+        {'tesla_ids': list(set(str(tesla_id) for tesla_id in tesla_ids)),
+         'instrument_ids': list(instrument_ids)}).fetchall()
+
+    for row in rows:
+        histograms[(row.tesla_id, row.instrument_id)][row.bin] = int(row.total)
+
+    return histograms
+
+
+def refresh_activity_levels(activity_id, context_statistics, version):
+    """
+    Compute and store the levels of the learners of an activity whose results changed since their levels were
+    computed. The trigger marks the rows it computes as outdated, so only the learners with outdated rows are computed
+    again, for each instrument and category. The levels of the other learners keep the context of the version they
+    were computed with. Rows changed while the levels are computed keep their level outdated.
+
+    :param activity_id: activity identifier
+    :param context_statistics: dictionary with the histogram and thresholds of each instrument in the activity, from
+        the context of the given version of the results
+    :param version: version of the activity results, as returned by get_activity_results_version
+    :return: number of rows whose level has been stored
+    """
+    if len(_get_outdated_learners(activity_id, limit=1)) == 0:
+        return 0
+
+    with queries.advisory_lock(('activity_learner_report', activity_id)):
+        # Other process could have computed them while waiting for the lock
+        tesla_ids = _get_outdated_learners(activity_id)
+        if len(tesla_ids) == 0:
+            return 0
+
+        summaries = get_activity_learners_summary(activity_id, tesla_ids)
+        histograms = get_learners_valid_results_histograms(tesla_ids, list(context_statistics.keys()))
+
+        learner_results = []
+        for tesla_id, summary in summaries.items():
+            summary_json = schemas.LearnerInstrumentResults(many=True).dump(summary).data
+            learner_results.append({'tesla_id': tesla_id,
+                                    'instruments': dict((inst['instrument_id'], inst) for inst in summary_json)})
+        learners_stats = risk.get_learners_instrument_stats(learner_results, context_statistics, histograms)
+
+        revisions = dict(((row.tesla_id, row.instrument_id), row.revision)
+                         for summary in summaries.values() for row in summary)
+        updates = {'tesla_ids': [], 'instrument_ids': [], 'levels': [], 'revisions': []}
+        for learner_result, learner_stats in zip(learner_results, learners_stats):
+            for instrument_id in learner_result['instruments'].keys():
+                instrument_stats = learner_stats['instruments'].get(instrument_id)
+                updates['tesla_ids'].append(learner_result['tesla_id'])
+                updates['instrument_ids'].append(instrument_id)
+                updates['levels'].append(None if instrument_stats is None else int(instrument_stats['level']))
+                updates['revisions'].append(revisions[(learner_result['tesla_id'], instrument_id)])
+
+        levels = {'tesla_ids': [], 'auth': [], 'content': [], 'security': [], 'worst_levels': []}
+        for learner_result, learner_stats in zip(learner_results, learners_stats):
+            levels['tesla_ids'].append(learner_result['tesla_id'])
+            for category in LEVEL_CATEGORIES:
+                levels[category].append(learner_stats['levels'][category])
+            levels['worst_levels'].append(_get_worst_level(learner_stats['levels']))
+
+        session = tesla_db.db.session
+        try:
+            session.execute(text(
+                "DELETE FROM activity_learner_levels WHERE activity_id = :activity_id "
+                "AND tesla_id = ANY(CAST(:tesla_ids AS TEXT[]))"),
+                {'activity_id': activity_id, 'tesla_ids': tesla_ids})
+            session.execute(text(
+                "INSERT INTO activity_learner_levels (activity_id, tesla_id, auth, content, security, worst_level) "
+                "SELECT :activity_id, v.* FROM unnest(CAST(:tesla_ids AS TEXT[]), CAST(:auth AS INTEGER[]), "
+                "CAST(:content AS INTEGER[]), CAST(:security AS INTEGER[]), CAST(:worst_levels AS INTEGER[])) AS v"),
+                dict(levels, activity_id=activity_id))
+            result = session.execute(text(
+                "UPDATE activity_learner_report a SET level = v.level, levels_version = :version "
+                "FROM unnest(CAST(:tesla_ids AS TEXT[]), CAST(:instrument_ids AS INTEGER[]), "
+                "CAST(:levels AS INTEGER[]), CAST(:revisions AS BIGINT[])) "
+                "AS v(tesla_id, instrument_id, level, revision) "
+                "WHERE a.activity_id = :activity_id AND a.tesla_id = v.tesla_id "
+                "AND a.instrument_id = v.instrument_id AND a.revision = v.revision"),
+                dict(updates, activity_id=activity_id, version=version))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        return result.rowcount
+
+
+def get_activity_learners_by_level(activity_id, instrument_ids=None, min_levels=None, max_levels=None,
+                                   worst_first=False, after=None, limit=20):
+    """
+    Get the learners of an activity filtered by their stored levels, using keyset pagination. Levels must be
+    refreshed with refresh_activity_levels before.
+
+    :param activity_id: activity identifier
+    :param instrument_ids: list of instrument identifiers. Only learners with results for some of them are returned.
+        Levels are not narrowed: filters and sorting use the levels of the learners over all the activity instruments.
+    :param min_levels: dictionary with the minimum level of each category
+    :param max_levels: dictionary with the maximum level of each category. Learners without level (0) for a category
+        are not returned when it is filtered.
+    :param worst_first: sort the learners by their worst level instead of by their TeSLA ID
+    :param after: position of the last learner of the previous page, (worst_level, tesla_id) when sorting by the worst
+        level and the TeSLA ID otherwise. None for the first page.
+    :param limit: maximum number of learners to return
+    :return: list of tuples with the TeSLA ID and the worst level of each learner
+    """
+    filters = ""
+    params = {'activity_id': activity_id, 'limit': limit}
+    bind_params = []
+    if instrument_ids is not None:
+        filters += ("AND EXISTS (SELECT 1 FROM activity_learner_report r WHERE r.activity_id = l.activity_id "
+                    "AND r.tesla_id = l.tesla_id AND r.instrument_id IN :instrument_ids) ")
+        params['instrument_ids'] = list(instrument_ids)
+        bind_params.append(bindparam('instrument_ids', expanding=True))
+    for category in LEVEL_CATEGORIES:
+        if min_levels is not None and min_levels.get(category) is not None:
+            filters += "AND l.{0} >= :min_{0} ".format(category)
+            params['min_' + category] = min_levels[category]
+        if max_levels is not None and max_levels.get(category) is not None:
+            filters += "AND l.{0} BETWEEN 1 AND :max_{0} ".format(category)
+            params['max_' + category] = max_levels[category]
+
+    if worst_first:
+        order = "l.worst_level, l.tesla_id"
+        if after is not None:
+            filters += "AND (l.worst_level, l.tesla_id) > (:after_level, :after_tesla_id) "
+            params['after_level'], params['after_tesla_id'] = after[0], str(after[1])
+    else:
+        order = "l.tesla_id"
+        if after is not None:
+            filters += "AND l.tesla_id > :after_tesla_id "
+            params['after_tesla_id'] = str(after)
+
+    statement = text(
+        "SELECT l.tesla_id, l.worst_level FROM activity_learner_levels l "
+        "WHERE l.activity_id = :activity_id " + filters +
+        "ORDER BY " + order + " LIMIT :limit")
+    if len(bind_params) > 0:
+        statement = statement.bindparams(*bind_params)
+
+    return [(row.tesla_id, row.worst_level) for row in tesla_db.db.session.execute(statement, params).fetchall()]
+
+
+def get_activity_learners_levels(activity_id, tesla_ids):
+    """
+    Get the stored levels of several learners in an activity, the ones used by get_activity_learners_by_level.
+
+    :param activity_id: activity identifier
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: dictionary with the auth, content, security and worst levels of each learner with stored levels
+    """
+    if len(tesla_ids) == 0:
+        return {}
+
+    rows = tesla_db.db.session.execute(text(
+        "SELECT tesla_id, auth, content, security, worst_level FROM activity_learner_levels "
+        "WHERE activity_id = :activity_id AND tesla_id IN :tesla_ids").bindparams(
+        bindparam('tesla_ids', expanding=True)),
+        {'activity_id': activity_id, 'tesla_ids': list(set(str(tesla_id) for tesla_id in tesla_ids))}).fetchall()
+
+    return dict((row.tesla_id, {'auth': row.auth, 'content': row.content, 'security': row.security,
+                                'worst_level': row.worst_level}) for row in rows)
+
+
+def _get_worst_level(levels):
+    levels = [levels[category] for category in LEVEL_CATEGORIES if levels[category] > 0]
+    if len(levels) == 0:
+        return NO_WORST_LEVEL
+    return min(levels)
+
+
+def _get_outdated_learners(activity_id, limit=None):
+    rows = tesla_db.db.session.execute(text(
+        "SELECT DISTINCT tesla_id FROM activity_learner_report "
+        "WHERE activity_id = :activity_id AND levels_version IS NULL LIMIT :limit"),
+        {'activity_id': activity_id, 'limit': limit}).fetchall()
+
+    return [row.tesla_id for row in rows]
+
+
+def _execute(statements):
+    if tesla_db.db.engine.name != 'postgresql':
+        raise RuntimeError('Activity reports require a PostgreSQL database')
+
+    session = tesla_db.db.session
+    try:
+        for statement in statements:
+            session.execute(text(statement))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
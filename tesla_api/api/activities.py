@@ -14,13 +14,13 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, stream_with_context, json
 from tesla_models import tep_db
 import tesla_models.schemas as schemas
 import tesla_models.validators as validators
 from tesla_models.helpers import api_response
 from tesla_models.errors import TESLA_API_STATUS_CODE
-from tesla_api import logger, tesla_db, utils
+from tesla_api import logger, tesla_db, utils, sync, queries, catalog
 from ..decorators import require_tesla_cert
 from tesla_models.database.utils import ResultsPagination
 
@@ -79,9 +79,9 @@ def add_activity():
         return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, errors, http_code=400)
 
     if tep_sync:
-        activity = tep_db.sync_activity(data.vle_id, data.activity_id, data.activity_type)
+        activity = sync.sync_activity(data.vle_id, data.activity_id, data.activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(data.vle_id, data.activity_type, data.activity_id)
+        activity = sync.get_activity_by_def(data.vle_id, data.activity_type, data.activity_id)
 
     if activity is not None:
         act_json = schemas.Activity().dump(activity).data
@@ -99,7 +99,9 @@ def add_activity():
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ERROR_PERSISTING_DATA, http_code=400)
 
-    activity = tesla_db.activities.get_activity(activity.id)
+    sync.invalidate_activity(data.vle_id, data.activity_type, data.activity_id)
+
+    activity = sync.get_activity(activity.id)
     act_json = schemas.Activity().dump(activity).data
 
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, act_json)
@@ -149,26 +151,28 @@ def get_activity(vle_id, activity_type, activity_id):
             +---------+----------------------------------------------------------------------------------------------+
 
     """
+    # Conditional requests matching the version stamp are answered before the activity is synchronized or read
+    etag = utils.get_activity_etag('activity', vle_id, activity_type, activity_id)
+    not_modified = utils.not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
+        etag = utils.get_activity_etag('activity', vle_id, activity_type, activity_id)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
-    if activity is None:
+    if activity is None or etag is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
 
-    act_json = schemas.Activity().dump(activity).data
-    act_json['tesla_active'] = False
+    def build_response():
+        act_json = schemas.Activity().dump(activity).data
+        act_json['tesla_active'] = utils.is_activity_tesla_active(activity.id)
 
-    act_instruments = tesla_db.activities.get_activity_all_instruments(activity.id)
+        return api_response(TESLA_API_STATUS_CODE.SUCCESS, act_json)
 
-    for instrument in act_instruments:
-        if instrument.active is True:
-            act_json['tesla_active'] = True
-            break
-
-    return api_response(TESLA_API_STATUS_CODE.SUCCESS, act_json)
+    return utils.etag_response(etag, build_response)
 
 
 @api_activities.route('/<int:vle_id>/<string:activity_type>/<string:activity_id>', methods=['PUT'])
@@ -223,9 +227,9 @@ def update_activity(vle_id, activity_type, activity_id):
         return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, errors, http_code=400)
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -238,7 +242,9 @@ def update_activity(vle_id, activity_type, activity_id):
         if not tesla_db.activities.update_activity_description(activity.id, data.description):
             return api_response(TESLA_API_STATUS_CODE.ERROR_PERSISTING_DATA, http_code=400)
 
-    activity = tesla_db.activities.get_activity(activity.id)
+    sync.invalidate_activity(vle_id, activity_type, activity_id)
+
+    activity = sync.get_activity(activity.id)
     act_json = schemas.Activity().dump(activity).data
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, act_json)
 
@@ -282,9 +288,9 @@ def delete_activity(vle_id, activity_type, activity_id):
     """
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -337,20 +343,30 @@ def get_activity_instruments(vle_id, activity_type, activity_id):
             +---------+----------------------------------------------------------------------------------------------+
 
     """
+    # Conditional requests matching the version stamp are answered before the activity is synchronized or read
+    etag = utils.get_activity_etag('activity_instruments', vle_id, activity_type, activity_id,
+                                   catalog.get_catalog().version)
+    not_modified = utils.not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
+        etag = utils.get_activity_etag('activity_instruments', vle_id, activity_type, activity_id,
+                                       catalog.get_catalog().version)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
-    if activity is None:
+    if activity is None or etag is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
 
-    act_instruments = tesla_db.activities.get_activity_all_instruments(activity.id)
+    def build_response():
+        act_instruments = tesla_db.activities.get_activity_all_instruments(activity.id)
+        instruments_json = schemas.ActivityInstrument(many=True).dump(act_instruments).data
 
-    instruments_json = schemas.ActivityInstrument(many=True).dump(act_instruments).data
+        return api_response(TESLA_API_STATUS_CODE.SUCCESS, {"instruments" : instruments_json})
 
-    return api_response(TESLA_API_STATUS_CODE.SUCCESS, {"instruments" : instruments_json})
+    return utils.etag_response(etag, build_response)
 
 
 @api_activities.route('/<int:vle_id>/<string:activity_type>/<string:activity_id>/instruments', methods=['POST'])
@@ -403,7 +419,7 @@ def set_activity_instruments(vle_id, activity_type, activity_id):
     if tep_sync:
         activity = tep_db.sync_activity(vle_id, activity_id, activity_type, data)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -411,9 +427,11 @@ def set_activity_instruments(vle_id, activity_type, activity_id):
     if not tesla_db.activities.update_activity_instrument_config(activity.id, data):
         return api_response(TESLA_API_STATUS_CODE.ERROR_PERSISTING_DATA, http_code=400)
 
-    act_instruments = tesla_db.activities.get_activity_all_instruments(activity.id)
-
+    sync.invalidate_activity(vle_id, activity_type, activity_id)
+    utils.invalidate_activity_instrument_config(activity.id)
 
+    act_instruments = tesla_db.activities.get_activity_all_instruments(activity.id)
+    utils.set_activity_tesla_active(activity.id, act_instruments)
 
     instruments_json = schemas.ActivityInstrument(many=True).dump(act_instruments).data
 
@@ -463,9 +481,9 @@ def get_activity_learners(vle_id, activity_type, activity_id):
     """
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -493,6 +511,11 @@ def get_activity_results(vle_id, activity_type, activity_id):
         :param activity_id: identifier of the activity in the VLE
         :type activity_id: string
 
+        :query cursor: opaque cursor returned as next_cursor by the previous page. When it is provided (empty for the
+            first page), learners are paginated by their TeSLA ID instead of by page number. Items have the same fields
+            with both paginations.
+        :query per_page: number of learners per page when using cursors.
+
         :<json uuid tesla_id: learner TeSLA ID
         :<json string public_cert: public certificate for the learner.
         :<json string cert_alg: algorithm used to create the public certificate.
@@ -501,6 +524,7 @@ def get_activity_results(vle_id, activity_type, activity_id):
         :>json string error_message: in case of error (status_code > 0) it provide a description of the error
 
         :status 200: request processed. In this case, check the status_code in order to verify if is correct or not.
+        :status 400: invalid cursor.
         :status 401: authorization denied. There is some problem with the provided certificates
         :status 404: activity not found.
         :status 500: unexpected error processing the request
@@ -519,21 +543,84 @@ def get_activity_results(vle_id, activity_type, activity_id):
     """
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
 
-    learners = tesla_db.activities.get_activity_learners_with_results(activity.id, pagination=ResultsPagination(request))
-    results = schemas.ActivitySummaryPagination().dump(learners).data
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        # Keyset pagination
+        per_page = utils.get_per_page(request)
+        try:
+            tesla_ids, next_cursor = utils.get_learners_page(activity.id, cursor, per_page)
+        except ValueError:
+            return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, {'cursor': ['Not a valid cursor.']}, http_code=400)
+        results = {'items': utils.get_learners_page_items(tesla_ids),
+                   'per_page': per_page,
+                   'next_cursor': next_cursor}
+    else:
+        learners = tesla_db.activities.get_activity_learners_with_results(activity.id,
+                                                                          pagination=ResultsPagination(request))
+        results = schemas.ActivitySummaryPagination().dump(learners).data
+
+    summaries = queries.get_activity_learners_summary(activity.id, [item['tesla_id'] for item in results['items']])
     for learner_result in results['items']:
-        tesla_id = learner_result['tesla_id']
-        summary = tesla_db.activities.get_activity_learner_summary(activity.id, tesla_id)
+        summary = summaries[str(learner_result['tesla_id'])]
         summary_json = schemas.InstrumentResultsSummary(many=True).dump(summary).data
         learner_result.update({"instruments": summary_json})
 
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, results)
 
 
+@api_activities.route('/<int:vle_id>/<string:activity_type>/<string:activity_id>/results/export', methods=['GET'])
+@require_tesla_cert()
+def export_activity_results(vle_id, activity_type, activity_id):
+    """
+        .. :quickref: Activities; Export activity results for all learners and instruments
+
+        Export activity results for all learners and instruments as newline delimited JSON. The response is streamed
+        while the results are read, with one line for each learner containing its tesla_id, the total number of valid,
+        failed and pending results and the summary of each instrument.
+
+        :reqheader Authorization: This method requires authentication based on client certificate.
+
+        :param vle_id: VLE identifier
+        :type vle_id: int
+        :param activity_type: type of the activity in the VLE
+        :type activity_type: string
+        :param activity_id: identifier of the activity in the VLE
+        :type activity_id: string
+
+        :status 200: request processed.
+        :status 401: authorization denied. There is some problem with the provided certificates
+        :status 404: activity not found.
+        :status 500: unexpected error processing the request
+
+    """
+
+    if tep_sync:
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
+    else:
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
+
+    if activity is None:
+        return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
+
+    activity_pk = activity.id
+    summary_schema = schemas.InstrumentResultsSummary(many=True)
+
+    def generate():
+        for tesla_id, summary in queries.iter_activity_learners_summary(activity_pk):
+            learner_result = {
+                'tesla_id': tesla_id,
+                'valid': sum(int(inst.valid) for inst in summary),
+                'failed': sum(int(inst.failed) for inst in summary),
+                'pending': sum(int(inst.pending) for inst in summary),
+                'instruments': summary_schema.dump(summary).data
+            }
+            yield json.dumps(learner_result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -17,9 +17,8 @@
 from flask import Blueprint, jsonify
 from tesla_models.helpers import api_response
 from tesla_models.errors import TESLA_API_STATUS_CODE
-from tesla_models import schemas
 from tesla_models import tep_db
-from tesla_api import logger, tesla_db
+from tesla_api import logger, catalog, sync, utils
 from ..decorators import require_tesla_cert
 
 api_instruments = Blueprint('api_instruments', __name__)
@@ -55,16 +54,20 @@ def get_instruments():
             +---------+----------------------------------------------------------------------------------------------+
 
     """
-    instruments = tesla_db.instruments.get_instruments()
+    # The catalog version identifies the instruments. It is read from the database on each request, so all the
+    # worker processes send the same ETag, and it is checked before building the response
+    instrument_catalog = catalog.get_catalog(force_check=True)
+    etag = utils.make_etag('instruments', instrument_catalog.version)
 
-    if instruments is None:
-        return api_response(TESLA_API_STATUS_CODE.INSTRUMENT_NOT_FOUND, http_code=404)
+    def build_response():
+        instruments_json = instrument_catalog.get_instruments()
 
-    instruments_json = schemas.Instrument(many=True).dump(instruments).data
-    response = {}
-    response['items'] = instruments_json
+        response = {}
+        response['items'] = instruments_json
 
-    return api_response(TESLA_API_STATUS_CODE.SUCCESS, response)
+        return api_response(TESLA_API_STATUS_CODE.SUCCESS, response)
+
+    return utils.etag_response(etag, build_response)
 
 
 @api_instruments.route('/<int:instrument_id>/thresholds', methods=['GET'])
@@ -105,15 +108,27 @@ def get_instrument_thresholds(instrument_id):
 
     """
 
-    if tep_sync is True:
-        tep_db.sync_instrument_thresholds()
+    # The ETag depends on the catalog version, so it is read from the database on each request. Conditional requests
+    # matching it are answered before the thresholds are synchronized.
+    instrument_catalog = catalog.get_catalog(force_check=True)
+    not_modified = utils.not_modified_response(
+        utils.make_etag('instrument_thresholds', instrument_id, instrument_catalog.version))
+    if not_modified is not None:
+        return not_modified
 
-    threshold = tesla_db.instruments.get_instrument_thresholds(instrument_id)
+    if tep_sync is True and sync.inline_sync():
+        tep_db.sync_instrument_thresholds()
+        instrument_catalog = catalog.get_catalog(force_check=True)
 
-    if threshold is None:
+    if not instrument_catalog.has_thresholds(instrument_id):
         return api_response(TESLA_API_STATUS_CODE.INSTRUMENT_THRESHOLD_NOT_FOUND, http_code=404)
 
-    threshold_json = schemas.InstrumentThreshold().dump(threshold).data
+    etag = utils.make_etag('instrument_thresholds', instrument_id, instrument_catalog.version)
+
+    def build_response():
+        threshold_json = instrument_catalog.get_instrument_thresholds(instrument_id)
+
+        return api_response(TESLA_API_STATUS_CODE.SUCCESS, threshold_json)
 
-    return api_response(TESLA_API_STATUS_CODE.SUCCESS, threshold_json)
+    return utils.etag_response(etag, build_response)
 
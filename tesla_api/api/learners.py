@@ -14,19 +14,28 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request
 from tesla_models import tep_db, schemas
 from tesla_models.helpers import api_response
 from tesla_models.errors import TESLA_API_STATUS_CODE
-from tesla_models.constants import TESLA_ENROLLMENT_PHASE
-from tesla_api import tesla_db
+from tesla_api import tesla_db, catalog, sync, queries
 from ..decorators import require_tesla_cert
-from ..utils import get_learner_ic_info, get_learner_send_info
+from ..utils import get_learner_ic_info, get_learner_send_info, get_learner_send_profile, get_ic_info, \
+    get_learner_send_profiles, resolve_learner_instruments, get_activity_instrument_config, get_enrolment_phase, \
+    get_enrolment_matrix
 import json
+import os
+import uuid
 api_learners = Blueprint('api_learners', __name__)
 
 tep_sync = True
 
+# Maximum number of learners in bulk requests
+BULK_LEARNERS_MAX = int(os.getenv('BULK_LEARNERS_MAX', 1000))
+
+# Number of learners computed on each page of the enrolment matrix
+ENROLMENT_MATRIX_PAGE_SIZE = int(os.getenv('ENROLMENT_MATRIX_PAGE_SIZE', 200))
+
 
 @api_learners.route('', methods=['POST'])
 @require_tesla_cert()
@@ -342,22 +351,14 @@ def get_learner_instrument_enrolment(tesla_id, instrument_id):
     tesla_id = str(tesla_id)
 
     # BEGIN: Synchronize data with TEP
-    tep_db.sync_learner(tesla_id)
+    sync.sync_learner(tesla_id)
     # END: Synchronize data with TEP
 
-    learner_enrolment = tesla_db.learners.get_learner_enrolment(tesla_id, instrument_id)
-    if learner_enrolment is None:
+    status = queries.get_learner_instrument_enrolment_status(tesla_id, instrument_id)
+    phase = get_enrolment_phase(status['percentage'], status['completed'], status['pending'])
+    percentage = status['percentage']
+    if percentage is None:
         percentage = 0.0
-        completed_enrollments = tesla_db.learners.count_learner_completed_requests(tesla_id, True, instrument_id)
-        pending_enrollments = tesla_db.learners.count_learner_pending_requests(tesla_id, True, instrument_id)
-        phase = TESLA_ENROLLMENT_PHASE.NOT_STARTED
-        if completed_enrollments > 0 or pending_enrollments > 0:
-            phase = TESLA_ENROLLMENT_PHASE.ONGOING
-    else:
-        percentage = learner_enrolment.percentage
-        phase = TESLA_ENROLLMENT_PHASE.ONGOING
-        if percentage == 1.0:
-            phase = TESLA_ENROLLMENT_PHASE.COMPLETED
 
     pending_requests = tesla_db.learners.get_learner_pending_enrolment_requests(tesla_id, instrument_id)
 
@@ -373,6 +374,60 @@ def get_learner_instrument_enrolment(tesla_id, instrument_id):
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, response)
 
 
+@api_learners.route('/enrolment', methods=['POST'])
+@require_tesla_cert()
+def get_learners_enrolment():
+    """
+        .. :quickref: Learners; Get enrolment information for a list of learners and instruments
+
+        Get the enrolment phase and completion of each learner in a list for each instrument in a list. The learners are
+        computed in pages of ENROLMENT_MATRIX_PAGE_SIZE.
+
+        :reqheader Authorization: This method requires authentication based on client certificate.
+
+        :<json list tesla_ids: list of learner TeSLA IDs following RFC4122 v4 standard.
+        :<json list instrument_ids: list of instrument identifiers. If not provided, all the instruments requiring
+            enrolment are used.
+
+        :>json int status_code: indicates if the request is correctly processed or some error occurred.
+        :>json string error_message: in case of error (status_code > 0) it provide a description of the error
+        :>json list learners: for each learner, its tesla_id and the enrolment_phase_id and enrolment_completion for
+            each instrument.
+
+        :status 200: request processed. In this case, check the status_code in order to verify if is correct or not.
+        :status 400: invalid request JSON
+        :status 401: authorization denied. There is some problem with the provided certificates
+        :status 500: unexpected error processing the request
+
+        **Response Status Codes**
+            +---------+----------------------------------------------------------------------------------------------+
+            |**Code** | **Description**                                                                              |
+            +---------+----------------------------------------------------------------------------------------------+
+            | 0       | Success!                                                                                     |
+            +---------+----------------------------------------------------------------------------------------------+
+            | 53      | Request JSON error. It contains more data or some required fields are missing.               |
+            +---------+----------------------------------------------------------------------------------------------+
+
+    """
+    data = request.get_json(silent=True)
+    tesla_ids, errors = _get_bulk_tesla_ids(data)
+    if errors is not None:
+        return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, errors, http_code=400)
+
+    instrument_ids = data.get('instrument_ids')
+    if instrument_ids is None:
+        instrument_ids = catalog.get_enrolment_instrument_ids()
+    elif not isinstance(instrument_ids, list) or not all(isinstance(i, int) for i in instrument_ids):
+        errors = {'instrument_ids': ['A list of instrument identifiers is required.']}
+        return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, errors, http_code=400)
+
+    learners = []
+    for start in range(0, len(tesla_ids), ENROLMENT_MATRIX_PAGE_SIZE):
+        learners.extend(get_enrolment_matrix(tesla_ids[start:start + ENROLMENT_MATRIX_PAGE_SIZE], instrument_ids))
+
+    return api_response(TESLA_API_STATUS_CODE.SUCCESS, {'learners': learners})
+
+
 @api_learners.route('/<uuid:tesla_id>/activities/<int:vle_id>/<string:activity_type>/<string:activity_id>/enrolments', methods=['GET'])
 @require_tesla_cert()
 def get_learner_activity_enrolments(tesla_id, vle_id, activity_type, activity_id):
@@ -480,35 +535,24 @@ def get_learner_activity_instruments(tesla_id, vle_id, activity_type, activity_i
         return api_response(TESLA_API_STATUS_CODE.INFORMED_CONSENT_OUTDATED, response)
 
     # BEGIN: Synchronize data with TEP
-    act_synch = tep_db.sync_activity(vle_id, activity_id, activity_type)
+    sync.sync_activity(vle_id, activity_id, activity_type)
     # END: Synchronize data with TEP
 
     # Get the activity
-    activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+    activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, response)
 
     # Get the instruments activated for this activity
-    act_instruments = tesla_db.activities.get_activity_instruments(activity.id)
+    act_config = get_activity_instrument_config(activity.id)
 
     # Get learner SEND information
-    send_info = get_learner_send_info(tesla_id)
+    send_profile = get_learner_send_profile(tesla_id)
+    send_info = send_profile.to_json()
     response['send'] = send_info['send']
 
     # Create the list of instruments
-    instruments = []
-    if act_instruments is not None:
-        for inst in act_instruments:
-            if send_info['is_send']:
-                if inst.instrument_id in send_info['send']['disabled_instruments']:
-                    if not inst.required:
-                        if inst.alternative_instrument_id is not None and inst.alternative_instrument_id not in \
-                                send_info['send']['disabled_instruments']:
-                            instruments.append(inst.alternative_instrument_id)
-                else:
-                    instruments.append(inst.instrument_id)
-            else:
-                instruments.append(inst.instrument_id)
+    instruments = resolve_learner_instruments(act_config, send_profile)
 
     # Create the final response
     response = {'learner_found': True,
@@ -520,6 +564,100 @@ def get_learner_activity_instruments(tesla_id, vle_id, activity_type, activity_i
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, response)
 
 
+@api_learners.route('/activities/<int:vle_id>/<string:activity_type>/<string:activity_id>/instruments', methods=['POST'])
+@require_tesla_cert()
+def get_learners_activity_instruments(vle_id, activity_type, activity_id):
+    """
+        .. :quickref: Learners; Get active instruments in a certain activity for a list of learners
+
+        Get all instruments to activate in a certain activity for each learner in a list. The activity is resolved
+        once and the informed consent and SEND information of all the learners is loaded together.
+
+        :reqheader Authorization: This method requires authentication based on client certificate.
+
+        :param vle_id: VLE identifier
+        :type vle_id: int
+        :param activity_type: type of the activity in the VLE
+        :type activity_type: string
+        :param activity_id: identifier of the activity in the VLE
+        :type activity_id: string
+
+        :<json list tesla_ids: list of learner TeSLA IDs following RFC4122 v4 standard.
+
+        :>json int status_code: indicates if the request is correctly processed or some error occurred.
+        :>json string error_message: in case of error (status_code > 0) it provide a description of the error
+        :>json list learners: for each learner, its tesla_id, status_code, learner_found, agreement_status,
+            instrument_ids and send data. The status_code of each learner is the one returned by the single learner
+            method.
+
+        :status 200: request processed. In this case, check the status_code in order to verify if is correct or not.
+        :status 400: invalid request JSON
+        :status 401: authorization denied. There is some problem with the provided certificates
+        :status 500: unexpected error processing the request
+
+        **Response Status Codes**
+            +---------+----------------------------------------------------------------------------------------------+
+            |**Code** | **Description**                                                                              |
+            +---------+----------------------------------------------------------------------------------------------+
+            | 0       | Success!                                                                                     |
+            +---------+----------------------------------------------------------------------------------------------+
+            | 53      | Request JSON error. It contains more data or some required fields are missing.               |
+            +---------+----------------------------------------------------------------------------------------------+
+
+    """
+    tesla_ids, errors = _get_bulk_tesla_ids(request.get_json(silent=True))
+    if errors is not None:
+        return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, errors, http_code=400)
+
+    # BEGIN: Synchronize data with TEP
+    sync.sync_activity(vle_id, activity_id, activity_type)
+    # END: Synchronize data with TEP
+
+    # Get the activity
+    activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
+    if activity is None:
+        return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, {'learners': []})
+
+    # Get the instruments activated for this activity
+    act_config = get_activity_instrument_config(activity.id)
+
+    # Get learners, informed consent and SEND information
+    learners = sync.sync_learners(tesla_ids, is_current=lambda learner: get_ic_info(learner)['ic_valid'])
+    send_profiles = get_learner_send_profiles(learners.keys())
+
+    response = []
+    for tesla_id in tesla_ids:
+        ic_info = get_ic_info(learners.get(tesla_id))
+
+        learner_response = {
+            'tesla_id': tesla_id,
+            'status_code': TESLA_API_STATUS_CODE.SUCCESS.value,
+            'learner_found': ic_info['learner_found'],
+            'agreement_status': ic_info['ic_valid'],
+            'instrument_ids': [],
+            'send': {}
+        }
+
+        if not ic_info['ic_valid']:
+            if not ic_info['learner_found']:
+                status_code = TESLA_API_STATUS_CODE.USER_NOT_FOUND
+            elif ic_info['ic_current_version'] is None:
+                status_code = TESLA_API_STATUS_CODE.INFORMED_CONSENT_NOT_ACCEPTED
+            elif ic_info['rejected_date'] is not None:
+                status_code = TESLA_API_STATUS_CODE.INFORMED_CONSENT_REJECTED
+            else:
+                status_code = TESLA_API_STATUS_CODE.INFORMED_CONSENT_OUTDATED
+            learner_response['status_code'] = status_code.value
+        else:
+            send_profile = send_profiles[tesla_id]
+            learner_response['instrument_ids'] = resolve_learner_instruments(act_config, send_profile)
+            learner_response['send'] = send_profile.to_json()
+
+        response.append(learner_response)
+
+    return api_response(TESLA_API_STATUS_CODE.SUCCESS, {'learners': response})
+
+
 @api_learners.route('/<uuid:tesla_id>/activities/<int:vle_id>/<string:activity_type>/<string:activity_id>/results', methods=['GET'])
 @require_tesla_cert()
 def get_learner_activity_results(tesla_id, vle_id, activity_type, activity_id):
@@ -563,9 +701,9 @@ def get_learner_activity_results(tesla_id, vle_id, activity_type, activity_id):
     """
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -623,9 +761,9 @@ def get_learner_activity_instrument_results(tesla_id, vle_id, activity_type, act
 
     """
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -684,9 +822,9 @@ def get_learner_activity_instrument_audit(tesla_id, vle_id, activity_type, activ
     """
 
     if tep_sync:
-        activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+        activity = sync.sync_activity(vle_id, activity_id, activity_type)
     else:
-        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -694,20 +832,20 @@ def get_learner_activity_instrument_audit(tesla_id, vle_id, activity_type, activ
     tesla_id = str(tesla_id)
 
     # Verify the learner
-    learner = tesla_db.learners.get_learner(tesla_id)
+    learner = sync.get_learner(tesla_id)
     if learner is None:
         return api_response(TESLA_API_STATUS_CODE.LEARNER_NOT_FOUND, http_code=404)
 
     # Verify the instrument
-    instrument = tesla_db.instruments.get_instrument_by_id(instrument_id)
+    instrument = catalog.get_instrument_by_id(instrument_id)
     if instrument is None:
         return api_response(TESLA_API_STATUS_CODE.INSTRUMENT_NOT_FOUND, http_code=404)
 
     # Check that the instrument have audit possibilities
-    if instrument.id not in [1, 6]:
+    if instrument['id'] not in [1, 6]:
         return api_response(TESLA_API_STATUS_CODE.SUCCESS, http_code=405)
 
-    audit_data = tep_db.get_activity_audit(activity.vle_id, activity.activity_type, activity.activity_id, tesla_id, instrument.id)
+    audit_data = tep_db.get_activity_audit(activity.vle_id, activity.activity_type, activity.activity_id, tesla_id, instrument['id'])
 
     for a in audit_data:
         if a['start'] is not None:
@@ -715,7 +853,7 @@ def get_learner_activity_instrument_audit(tesla_id, vle_id, activity_type, activ
         if a['finish'] is not None:
             a['finish'] = str(a['finish'])
     
-    if instrument.id == 1:
+    if instrument['id'] == 1:
         audit_data = _get_fr_audit_data(audit_data)
         if audit_data is None:
             audit_data = {
@@ -810,3 +948,18 @@ def get_learner_activity_request_instrument_audit(tesla_id, vle_id, activity_typ
 
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, http_code=501)
 
+
+def _get_bulk_tesla_ids(data):
+    tesla_ids = None
+    if isinstance(data, dict):
+        tesla_ids = data.get('tesla_ids')
+
+    if not isinstance(tesla_ids, list):
+        return None, {'tesla_ids': ['A list of learner TeSLA IDs is required.']}
+    if len(tesla_ids) > BULK_LEARNERS_MAX:
+        return None, {'tesla_ids': ['Up to {} learners are allowed.'.format(BULK_LEARNERS_MAX)]}
+
+    try:
+        return [str(uuid.UUID(str(tesla_id))) for tesla_id in tesla_ids], None
+    except ValueError:
+        return None, {'tesla_ids': ['Not a valid UUID.']}
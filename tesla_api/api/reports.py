@@ -20,7 +20,7 @@ import tesla_models.schemas as schemas
 import tesla_models.validators as validators
 from tesla_models.helpers import api_response
 from tesla_models.errors import TESLA_API_STATUS_CODE
-from tesla_api import logger, tesla_db, utils
+from tesla_api import logger, tesla_db, utils, catalog, sync, queries, risk, activity_reports
 from ..decorators import require_tesla_cert
 from tesla_models.database.utils import ReportsPagination
 from datetime import timedelta
@@ -47,12 +47,29 @@ def get_activity_report(vle_id, activity_type, activity_id, page = 1):
         :type activity_id: string
         :param page: number of page
         :type page: integer
+        :query cursor: opaque cursor returned as next_cursor by the previous page. When it is provided (empty for the
+            first page), learners are paginated by their TeSLA ID instead of by page number. Items have the same fields
+            with both paginations.
+        :query per_page: number of learners per page.
+        :query instruments: comma separated list of instrument identifiers. Only learners with requests for some of
+            them are returned. It does not narrow the levels: level filters and sorting use the levels of the learners
+            over all the activity instruments.
+        :query min_auth_level: minimum auth level of the learners. There are also min_content_level and
+            min_security_level.
+        :query max_auth_level: maximum auth level of the learners. Learners without auth level (0) are not returned.
+            There are also max_content_level and max_security_level.
+        :query order: use worst to sort the learners by their worst level, danger (1) first.
+            Level filters and sorting require the activity reports table, and are paginated with the cursor.
         :<json uuid tesla_id: learner TeSLA ID
         :<json string public_cert: public certificate for the learner.
         :<json string cert_alg: algorithm used to create the public certificate.
 
         :>json int status_code: indicates if the request is correctly processed or some error occurred.
         :>json string error_message: in case of error (status_code > 0) it provide a description of the error
+        :>json object results: paginated learners. When filtering or sorting by level, each learner also has levels,
+            the stored auth, content, security and worst levels used by the level filters and sorting (null if the
+            learner had no results when they were computed). Stored levels are only computed again for the learners
+            whose results changed, and stats are computed from the current results, so they can differ.
 
         :status 200: request processed. In this case, check the status_code in order to verify if is correct or not.
         :status 401: authorization denied. There is some problem with the provided certificates
@@ -72,7 +89,7 @@ def get_activity_report(vle_id, activity_type, activity_id, page = 1):
 
     """
     '''
-    activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+    activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
@@ -83,34 +100,75 @@ def get_activity_report(vle_id, activity_type, activity_id, page = 1):
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, results)
     '''
     # Verify the activity
-    activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+    activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
 
     # Get filter parameters from request query parameters
-    max_per_page = 20
-    instrument_ids = None
+    max_per_page = utils.get_per_page(request)
+    cursor = request.args.get('cursor')
+    try:
+        instrument_ids, min_levels, max_levels, worst_first = _get_report_filters(request.args)
+    except ValueError as ex:
+        return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, {str(ex): ['Not a valid value.']}, http_code=400)
+
+    level_filters = worst_first or len(min_levels) > 0 or len(max_levels) > 0
+    if level_filters and not activity_reports.ACTIVITY_REPORTS:
+        return api_response(TESLA_API_STATUS_CODE.INVALID_JSON,
+                            {'order': ['Filtering and sorting by level requires the activity reports.']},
+                            http_code=400)
 
     # Get the list of instruments that have some request for this activity
-    activity_instruments = tesla_db.reports.get_activity_instruments_with_requests(activity.id)
+    results_version = utils.get_activity_results_version(activity.id)
+    activity_context = utils.get_activity_context(activity.id, results_version)
+    activity_instruments = [catalog.get_instrument_by_id(instrument_id)
+                            for instrument_id in activity_context['instrument_ids']]
+    activity_instruments = [instrument for instrument in activity_instruments if instrument is not None]
 
     # Get activity statistics for involved instruments
     context_statistics = {}
     for instrument in activity_instruments:
-        context_statistics[instrument.id] = {}
-        context_statistics[instrument.id]['histogram'] = tesla_db.statistics.verification_activity_results_histogram(
-            activity.id, instrument.id)
-        context_statistics[instrument.id]['thresholds'] = schemas.InstrumentThreshold().dump(tesla_db.instruments.get_instrument_thresholds(
-            instrument.id)).data
+        context_statistics[instrument['id']] = {}
+        context_statistics[instrument['id']]['histogram'] = activity_context['histograms'][instrument['id']]
+        context_statistics[instrument['id']]['thresholds'] = catalog.get_instrument_thresholds(instrument['id'])
+
+    # Update the stored levels of the learners whose results changed, when they are used to filter or sort
+    if level_filters:
+        activity_reports.refresh_activity_levels(activity.id, context_statistics, results_version)
 
     # Get a paginated list of learners that will be in the response
-    learners = tesla_db.reports.get_activity_learners_with_results(activity.id, page=page, max_per_page=max_per_page, instrument_ids=instrument_ids)
+    learners = None
+    if level_filters or cursor is not None:
+        try:
+            if level_filters:
+                tesla_ids, next_cursor = utils.get_learners_page_by_level(
+                    activity.id, cursor, max_per_page, instrument_ids=instrument_ids, min_levels=min_levels,
+                    max_levels=max_levels, worst_first=worst_first)
+            else:
+                tesla_ids, next_cursor = utils.get_learners_page(activity.id, cursor, max_per_page,
+                                                                 instrument_ids=instrument_ids)
+        except ValueError:
+            return api_response(TESLA_API_STATUS_CODE.INVALID_JSON, {'cursor': ['Not a valid cursor.']}, http_code=400)
+        results = {'items': utils.get_learners_page_items(tesla_ids),
+                   'per_page': max_per_page,
+                   'next_cursor': next_cursor}
+    else:
+        learners = tesla_db.reports.get_activity_learners_with_results(activity.id, page=page,
+                                                                       max_per_page=max_per_page,
+                                                                       instrument_ids=instrument_ids)
+        results = schemas.ActivitySummaryPagination().dump(learners).data
 
     # Get the data for each learner
-    results = schemas.ActivitySummaryPagination().dump(learners).data
+    tesla_ids = [item['tesla_id'] for item in results['items']]
+    if activity_reports.ACTIVITY_REPORTS:
+        summaries = activity_reports.get_activity_learners_summary(activity.id, tesla_ids)
+        histograms = activity_reports.get_learners_valid_results_histograms(tesla_ids,
+                                                                            list(context_statistics.keys()))
+    else:
+        summaries = queries.get_activity_learners_summary(activity.id, tesla_ids)
+        histograms = queries.get_learners_valid_results_histograms(tesla_ids, list(context_statistics.keys()))
     for learner_result in results['items']:
-        tesla_id = learner_result['tesla_id']
-        summary = tesla_db.activities.get_activity_learner_summary(activity.id, tesla_id)
+        summary = summaries[str(learner_result['tesla_id'])]
         summary_json = schemas.LearnerInstrumentResults(many=True).dump(summary).data
 
         # Build indexed data to make easier the results visualization
@@ -121,17 +179,27 @@ def get_activity_report(vle_id, activity_type, activity_id, page = 1):
         # Update the learner data on the paginated view
         learner_result.update({"instruments": indexed_info})
 
-        # Add learner level statistics
-        learner_result.update({"stats": _get_learner_instrument_stats(learner_result, context_statistics)})
+    # Add learner level statistics
+    learners_stats = risk.get_learners_instrument_stats(results['items'], context_statistics, histograms)
+    for learner_result, learner_stats in zip(results['items'], learners_stats):
+        learner_result.update({"stats": learner_stats})
+
+    # Add the stored levels used to filter and sort the learners
+    if level_filters:
+        stored_levels = activity_reports.get_activity_learners_levels(activity.id, tesla_ids)
+        for learner_result in results['items']:
+            learner_result.update({"levels": stored_levels.get(str(learner_result['tesla_id']))})
 
     # Build the paginated iterator as a list, since items type is JSON.
-    results['iter_pages'] = [p for p in learners.iter_pages(left_edge=1, left_current=2, right_current=3, right_edge=1)]
+    if learners is not None:
+        results['iter_pages'] = [p for p in learners.iter_pages(left_edge=1, left_current=2, right_current=3,
+                                                                right_edge=1)]
 
     act_json = schemas.Activity().dump(activity).data
     return_data = {
         'results': results,
         'activity': act_json,
-        'instruments': schemas.Instrument(many=True).dump(activity_instruments).data
+        'instruments': activity_instruments
     }
 
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, return_data)
@@ -186,32 +254,36 @@ def get_activity_learner_report(vle_id, activity_type, activity_id, tesla_id):
 
     """
 
-    activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+    activity = sync.get_activity_by_def(vle_id, activity_type, activity_id)
 
     if activity is None:
         return api_response(TESLA_API_STATUS_CODE.ACTIVITY_NOT_FOUND, http_code=404)
 
-    learner = tesla_db.learners.get_learner(tesla_id)
+    learner = sync.get_learner(tesla_id)
     
     if learner is None:
         return api_response(TESLA_API_STATUS_CODE.LEARNER_NOT_FOUND, http_code=404)
 
 
     # Get the list of instruments that have some request for this activity
-    activity_instruments = tesla_db.reports.get_activity_instruments_with_requests(activity.id)
+    activity_context = utils.get_activity_context(activity.id)
+    activity_instruments = [catalog.get_instrument_by_id(instrument_id)
+                            for instrument_id in activity_context['instrument_ids']]
+    activity_instruments = [instrument for instrument in activity_instruments if instrument is not None]
 
     # Get activity statistics for involved instruments
     context_statistics = {}
     for instrument in activity_instruments:
-        context_statistics[instrument.id] = {}
-        context_statistics[instrument.id][
-            'histogram'] = tesla_db.statistics.verification_activity_results_histogram(activity.id, instrument.id)
-        context_statistics[instrument.id]['thresholds'] = schemas.InstrumentThreshold().dump(tesla_db.instruments.get_instrument_thresholds(
-            instrument.id)).data
-        context_statistics[instrument.id]['temporal'] = _get_temporal_results(tesla_db.reports.get_activity_learner_temporal_results(activity.id, tesla_id, instrument.id))
-        context_statistics[instrument.id]['aronym'] = instrument.acronym
-
-    summary = tesla_db.activities.get_activity_learner_summary(activity.id, tesla_id)
+        context_statistics[instrument['id']] = {}
+        context_statistics[instrument['id']]['histogram'] = activity_context['histograms'][instrument['id']]
+        context_statistics[instrument['id']]['thresholds'] = catalog.get_instrument_thresholds(instrument['id'])
+        context_statistics[instrument['id']]['temporal'] = _get_temporal_results(tesla_db.reports.get_activity_learner_temporal_results(activity.id, tesla_id, instrument['id']))
+        context_statistics[instrument['id']]['aronym'] = instrument['acronym']
+
+    if activity_reports.ACTIVITY_REPORTS:
+        summary = activity_reports.get_activity_learners_summary(activity.id, [tesla_id])[str(tesla_id)]
+    else:
+        summary = tesla_db.activities.get_activity_learner_summary(activity.id, tesla_id)
     summary_json = schemas.LearnerInstrumentResults(many=True).dump(summary).data
 
     # Build indexed data to make easier the results visualization
@@ -228,13 +300,17 @@ def get_activity_learner_report(vle_id, activity_type, activity_id, tesla_id):
     }
 
     # Add learner level statistics
-    learner_result.update({"stats": _get_learner_instrument_stats(learner_result, context_statistics)})
+    if activity_reports.ACTIVITY_REPORTS:
+        histograms = activity_reports.get_learners_valid_results_histograms([tesla_id], list(context_statistics.keys()))
+    else:
+        histograms = queries.get_learners_valid_results_histograms([tesla_id], list(context_statistics.keys()))
+    learner_result.update({"stats": _get_learner_instrument_stats(learner_result, context_statistics, histograms)})
 
     act_json = schemas.Activity().dump(activity).data
     result = {
         'learner': learner_result,
         'object': act_json,
-        'instruments': schemas.Instrument(many=True).dump(activity_instruments).data,
+        'instruments': activity_instruments,
         'context_statistics': context_statistics,
         'tesla_id': str(tesla_id)
     }
@@ -242,6 +318,39 @@ def get_activity_learner_report(vle_id, activity_type, activity_id, tesla_id):
     return api_response(TESLA_API_STATUS_CODE.SUCCESS, result)
 
 
+def _get_report_filters(args):
+    """
+    Get the learner filters of an activity report from the request query parameters
+
+    :return: tuple with the list of instrument identifiers, the minimum and maximum levels of each category and if
+        learners are sorted by their worst level
+    :raises ValueError: if some parameter is not valid. The message is the name of the parameter.
+    """
+    instrument_ids = None
+    if args.get('instruments'):
+        try:
+            instrument_ids = [int(instrument_id) for instrument_id in args.get('instruments').split(',')]
+        except ValueError:
+            raise ValueError('instruments')
+
+    min_levels = {}
+    max_levels = {}
+    for category in activity_reports.LEVEL_CATEGORIES:
+        for name, levels in (('min_{}_level'.format(category), min_levels),
+                             ('max_{}_level'.format(category), max_levels)):
+            if args.get(name) is not None:
+                try:
+                    levels[category] = int(args.get(name))
+                except ValueError:
+                    raise ValueError(name)
+
+    order = args.get('order')
+    if order not in (None, '', 'worst'):
+        raise ValueError('order')
+
+    return instrument_ids, min_levels, max_levels, order == 'worst'
+
+
 def _get_temporal_results(data, break_far_samples=True):
 
     max_gap_seconds = 240
@@ -270,7 +379,11 @@ def _get_temporal_results(data, break_far_samples=True):
     return res_struct
 
 
-def _get_learner_instrument_stats(learner_result, context_statistics):
+def _get_learner_instrument_stats(learner_result, context_statistics, histograms):
+    """
+    Compute the instrument statistics and risk levels of a single learner. Reports of several learners use
+    risk.get_learners_instrument_stats, which must give the same values.
+    """
 
     learner_stats = {}
     learner_stats['instruments'] = {}
@@ -323,8 +436,7 @@ def _get_learner_instrument_stats(learner_result, context_statistics):
         # If learner have data for this instrument, update the statistics
         if instrument_id in learner_result['instruments']:
             context_hist = context_statistics[instrument_id]['histogram']
-            histogram = tesla_db.statistics.get_learner_instrument_valid_results_histogram(learner_result['tesla_id'],
-                                                                                           instrument_id)
+            histogram = histograms[(str(learner_result['tesla_id']), instrument_id)]
 
             confidence = learner_result['instruments'][instrument_id]['valid'] / (learner_result['instruments'][instrument_id]['valid'] + learner_result['instruments'][instrument_id]['failed'] + 0.00000001)
 
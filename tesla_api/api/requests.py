@@ -17,7 +17,7 @@
 from flask import Blueprint, jsonify, request
 from tesla_models.helpers import api_response
 from tesla_models.errors import TESLA_API_STATUS_CODE
-from tesla_api import logger, tesla_db
+from tesla_api import logger, tesla_db, sync
 from tesla_models import tesla_storage, validators
 from ..decorators import require_tesla_cert
 
@@ -69,7 +69,7 @@ def get_request(request_id):
 
     activity = None
     if request.activity_id is not None:
-        activity = tesla_db.activities.get_activity(request.activity_id)
+        activity = sync.get_activity(request.activity_id)
 
     request_data = tesla_storage.load_request_data(request_id)
 
@@ -0,0 +1,156 @@
+"""
+TeSLA in-process caches
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Bounded LRU cache whose entries expire after a fixed time to live. It is shared by all the threads of a worker
+    process, so all the operations are protected by a lock.
+
+    :param maxsize: maximum number of entries. When it is reached, the least recently used entry is discarded.
+    :param ttl: time to live of the entries in seconds. A value of 0 disables the cache.
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """
+        Get an entry even if it is expired, so it can be served while it is refreshed.
+
+        :return: tuple with the value and a boolean indicating if it is still fresh
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default, False
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1] > time.time()
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """
+        Remove all the entries whose value matches the given predicate.
+
+        :param predicate: function receiving an entry value and returning True if it must be removed.
+        :return: number of removed entries
+        """
+        with self._lock:
+            keys = [key for key, entry in self._data.items() if predicate(entry[0])]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent executions for the same key. While a call is in flight, the threads requesting the same key
+    wait for it and share its result instead of executing the function again. Results are shared between threads,
+    so they must not be objects attached to a database session.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = _FlightCall()
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+
+class _FlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
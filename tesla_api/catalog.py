@@ -0,0 +1,172 @@
+"""
+TeSLA instrument catalog
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import os
+import threading
+import time
+from tesla_api import tesla_db, logger, queries
+from tesla_models import schemas
+from tesla_models.models import instrument_schema
+
+# Minimum time between two checks of the catalog version stamp
+CHECK_INTERVAL = int(os.getenv('INSTRUMENT_CATALOG_CHECK_INTERVAL', 30))
+
+
+class InstrumentCatalog(object):
+    """
+    Immutable snapshot of the instruments and their thresholds, with the serialized JSON objects used by the API.
+    Accessors return copies, so the snapshot can be shared by all the requests of the process.
+
+    :param version: version stamp of the instrument tables when the snapshot was taken
+    :param instruments: list of instruments
+    :param thresholds: dictionary with the thresholds of each instrument id
+    """
+    def __init__(self, version, instruments, thresholds):
+        self.version = version
+        self._instruments_json = schemas.Instrument(many=True).dump(instruments).data
+        self._by_id = {}
+        self._by_acronym = {}
+        self._module_json = {}
+        self._thresholds_json = {}
+        for instrument, instrument_json in zip(instruments, self._instruments_json):
+            self._by_id[instrument.id] = instrument_json
+            self._by_acronym[instrument.acronym.upper()] = instrument_json
+            self._module_json[instrument.acronym.upper()] = instrument_schema.dump(instrument)[0]
+            self._thresholds_json[instrument.id] = schemas.InstrumentThreshold().dump(thresholds.get(instrument.id)).data
+        self._thresholds = frozenset([instrument_id for instrument_id, threshold in thresholds.items()
+                                      if threshold is not None])
+        self._enrolment_ids = [instrument.id for instrument in instruments if instrument.requires_enrollment]
+
+    def get_instruments(self):
+        return copy.deepcopy(self._instruments_json)
+
+    def get_instrument_by_id(self, instrument_id):
+        return copy.deepcopy(self._by_id.get(instrument_id))
+
+    def get_instrument_by_acronym(self, acronym):
+        return copy.deepcopy(self._by_acronym.get(acronym.upper()))
+
+    def get_instrument_module(self, acronym):
+        """
+        Get the instrument in the format used by certificate modules.
+        """
+        return copy.deepcopy(self._module_json.get(acronym.upper()))
+
+    def get_enrolment_instrument_ids(self):
+        """
+        Get the identifiers of the instruments requiring enrolment, as set in their requires_enrollment column.
+        """
+        return list(self._enrolment_ids)
+
+    def has_thresholds(self, instrument_id):
+        return instrument_id in self._thresholds
+
+    def get_instrument_thresholds(self, instrument_id):
+        """
+        Get the serialized thresholds of an instrument. Instruments without thresholds return the serialization of
+        an empty threshold, as the reports expect.
+        """
+        if instrument_id not in self._thresholds_json:
+            return schemas.InstrumentThreshold().dump(None).data
+        return copy.deepcopy(self._thresholds_json[instrument_id])
+
+
+_catalog = None
+_checked = 0
+_lock = threading.Lock()
+_reload_listeners = []
+
+
+def get_catalog(force_check=False):
+    """
+    Get the current instrument catalog. The version stamp of the instrument tables is checked at most once every
+    CHECK_INTERVAL seconds, and the catalog is only reloaded when it changes.
+
+    :param force_check: check the version stamp even if the check interval has not expired
+    """
+    global _catalog, _checked
+
+    if _catalog is not None and not force_check and time.time() - _checked < CHECK_INTERVAL:
+        return _catalog
+
+    with _lock:
+        if _catalog is not None and not force_check and time.time() - _checked < CHECK_INTERVAL:
+            return _catalog
+
+        version = queries.get_instrument_catalog_version()
+        if _catalog is None or _catalog.version != version:
+            _catalog = _load_catalog(version)
+            for listener in _reload_listeners:
+                listener()
+        _checked = time.time()
+
+    return _catalog
+
+
+def _load_catalog(version):
+    logger.debug('Loading instrument catalog with version {}'.format(version))
+    instruments = tesla_db.instruments.get_instruments()
+    if instruments is None:
+        instruments = []
+
+    thresholds = {}
+    for instrument in instruments:
+        thresholds[instrument.id] = tesla_db.instruments.get_instrument_thresholds(instrument.id)
+
+    return InstrumentCatalog(version, instruments, thresholds)
+
+
+def invalidate():
+    """
+    Force a check of the version stamp on the next access to the catalog.
+    """
+    global _checked
+    _checked = 0
+
+
+def on_reload(listener):
+    """
+    Register a function to be called each time the catalog is reloaded.
+    """
+    _reload_listeners.append(listener)
+
+
+def get_instruments():
+    return get_catalog().get_instruments()
+
+
+def get_instrument_by_id(instrument_id):
+    return get_catalog().get_instrument_by_id(instrument_id)
+
+
+def get_instrument_by_acronym(acronym):
+    return get_catalog().get_instrument_by_acronym(acronym)
+
+
+def get_instrument_module(acronym):
+    return get_catalog().get_instrument_module(acronym)
+
+
+def get_instrument_thresholds(instrument_id):
+    return get_catalog().get_instrument_thresholds(instrument_id)
+
+
+def get_enrolment_instrument_ids():
+    return get_catalog().get_enrolment_instrument_ids()
@@ -0,0 +1,148 @@
+"""
+TeSLA enrolment counters
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import text
+from tesla_api import tesla_db
+
+# Requests are created by the TEP and their status is updated by the instruments, so the counters are maintained by
+# the database itself. Deleted requests subtract their results before they are removed, since the results deleted by
+# the cascade no longer find their request. A change of the request or instrument of an existing result, or of the
+# learner of a request, is not tracked, and requires a rebuild of the counters.
+INSTALL_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS learner_enrolment_counter ("
+    "tesla_id TEXT NOT NULL, "
+    "instrument_id INTEGER NOT NULL, "
+    "completed INTEGER NOT NULL DEFAULT 0, "
+    "pending INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (tesla_id, instrument_id))",
+
+    "CREATE OR REPLACE FUNCTION learner_enrolment_counter_update() RETURNS trigger AS $$ "
+    "DECLARE "
+    "    delta_completed INTEGER := 0; "
+    "    delta_pending INTEGER := 0; "
+    "    result_request_id INTEGER; "
+    "    result_instrument_id INTEGER; "
+    "    request_tesla_id TEXT; "
+    "BEGIN "
+    "    IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+    "        delta_completed := delta_completed - CASE WHEN OLD.status = 2 THEN 1 ELSE 0 END; "
+    "        delta_pending := delta_pending - CASE WHEN OLD.status IN (0, 1) THEN 1 ELSE 0 END; "
+    "        result_request_id := OLD.request_id; "
+    "        result_instrument_id := OLD.instrument_id; "
+    "    END IF; "
+    "    IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+    "        delta_completed := delta_completed + CASE WHEN NEW.status = 2 THEN 1 ELSE 0 END; "
+    "        delta_pending := delta_pending + CASE WHEN NEW.status IN (0, 1) THEN 1 ELSE 0 END; "
+    "        result_request_id := NEW.request_id; "
+    "        result_instrument_id := NEW.instrument_id; "
+    "    END IF; "
+    "    IF delta_completed = 0 AND delta_pending = 0 THEN "
+    "        RETURN NULL; "
+    "    END IF; "
+    "    SELECT tesla_id::text INTO request_tesla_id FROM request WHERE id = result_request_id AND is_enrolment; "
+    "    IF request_tesla_id IS NULL THEN "
+    "        RETURN NULL; "
+    "    END IF; "
+    "    INSERT INTO learner_enrolment_counter (tesla_id, instrument_id, completed, pending) "
+    "    VALUES (request_tesla_id, result_instrument_id, delta_completed, delta_pending) "
+    "    ON CONFLICT (tesla_id, instrument_id) DO UPDATE SET "
+    "        completed = learner_enrolment_counter.completed + EXCLUDED.completed, "
+    "        pending = learner_enrolment_counter.pending + EXCLUDED.pending; "
+    "    RETURN NULL; "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    "DROP TRIGGER IF EXISTS learner_enrolment_counter_update ON request_result",
+
+    "CREATE TRIGGER learner_enrolment_counter_update "
+    "AFTER INSERT OR UPDATE OF status OR DELETE ON request_result "
+    "FOR EACH ROW EXECUTE PROCEDURE learner_enrolment_counter_update()",
+
+    "CREATE OR REPLACE FUNCTION learner_enrolment_counter_request_delete() RETURNS trigger AS $$ "
+    "BEGIN "
+    "    IF NOT OLD.is_enrolment THEN "
+    "        RETURN OLD; "
+    "    END IF; "
+    "    UPDATE learner_enrolment_counter c SET "
+    "        completed = c.completed - d.completed, "
+    "        pending = c.pending - d.pending "
+    "    FROM (SELECT instrument_id, "
+    "          SUM(CASE WHEN status = 2 THEN 1 ELSE 0 END) AS completed, "
+    "          SUM(CASE WHEN status IN (0, 1) THEN 1 ELSE 0 END) AS pending "
+    "          FROM request_result WHERE request_id = OLD.id GROUP BY instrument_id) d "
+    "    WHERE c.tesla_id = OLD.tesla_id::text AND c.instrument_id = d.instrument_id; "
+    "    RETURN OLD; "
+    "END; "
+    "$$ LANGUAGE plpgsql",
+
+    "DROP TRIGGER IF EXISTS learner_enrolment_counter_request_delete ON request",
+
+    # Before the deletion, while the results of the request still exist
+    "CREATE TRIGGER learner_enrolment_counter_request_delete "
+    "BEFORE DELETE ON request "
+    "FOR EACH ROW EXECUTE PROCEDURE learner_enrolment_counter_request_delete()",
+]
+
+REBUILD_STATEMENTS = [
+    # Block result changes while the counters are computed, so no update is lost
+    "LOCK TABLE request_result IN SHARE MODE",
+
+    "DELETE FROM learner_enrolment_counter",
+
+    "INSERT INTO learner_enrolment_counter (tesla_id, instrument_id, completed, pending) "
+    "SELECT r.tesla_id::text, rr.instrument_id, "
+    "SUM(CASE WHEN rr.status = 2 THEN 1 ELSE 0 END), "
+    "SUM(CASE WHEN rr.status IN (0, 1) THEN 1 ELSE 0 END) "
+    "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+    "WHERE r.is_enrolment "
+    "GROUP BY r.tesla_id, rr.instrument_id",
+]
+
+
+def install_enrolment_counters():
+    """
+    Create the enrolment counters table and the trigger maintaining it. Existing counters are kept.
+    """
+    _execute(INSTALL_STATEMENTS)
+
+
+def rebuild_enrolment_counters():
+    """
+    Compute again all the enrolment counters from the requests. Result changes wait until the rebuild is committed,
+    so it must be run when the counters are installed or after changes that are not tracked, not periodically.
+
+    :return: number of counters
+    """
+    _execute(REBUILD_STATEMENTS)
+
+    return tesla_db.db.session.execute(text("SELECT COUNT(*) FROM learner_enrolment_counter")).scalar()
+
+
+def _execute(statements):
+    if tesla_db.db.engine.name != 'postgresql':
+        raise RuntimeError('Enrolment counters require a PostgreSQL database')
+
+    session = tesla_db.db.session
+    try:
+        for statement in statements:
+            session.execute(text(statement))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
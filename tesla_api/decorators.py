@@ -47,9 +47,14 @@ def certificate_required(f):
                 validated = True
                 return f(*args, **kwargs)
 
-            client_cert = request.environ.get('HTTP_X_SSL_CERT', None)
+            identity = secret.get_client_cert_identity(request)
+            if identity is not None:
+                valid_cert = secret.validate_client_cn(identity['cn'], authorized_clients)
+            else:
+                client_cert = request.environ.get('HTTP_X_SSL_CERT', None)
+                valid_cert = client_cert and secret.validate_client_cert(client_cert, authorized_clients)
 
-            if not client_cert or not secret.validate_client_cert(client_cert, authorized_clients):
+            if not valid_cert:
                 drain_request()
                 logger.info('Invalid Certificate')
                 return jsonify({'status_code': '54'}), 401  # code 54 for invalid client_cert
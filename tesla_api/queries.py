@@ -0,0 +1,423 @@
+"""
+TeSLA set based queries
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import zlib
+from contextlib import contextmanager
+from sqlalchemy import text, bindparam
+from tesla_api import tesla_db
+
+# Read enrolment request counts from the counters maintained by the database (see tesla_api.counters)
+ENROLMENT_COUNTERS = bool(int(os.getenv('ENROLMENT_COUNTERS', 0)))
+
+
+def get_instrument_catalog_version():
+    """
+    Get a version stamp for the instrument and instrument thresholds tables. It changes whenever a row is added,
+    modified or removed.
+
+    :return: tuple with the number of rows and last modification date of both tables
+    """
+    row = tesla_db.db.session.execute(text(
+        "SELECT (SELECT COUNT(*) FROM instrument), "
+        "(SELECT MAX(COALESCE(updated, created)) FROM instrument), "
+        "(SELECT COUNT(*) FROM instrument_thresholds), "
+        "(SELECT MAX(COALESCE(updated, created)) FROM instrument_thresholds)")).first()
+
+    return tuple(str(value) for value in row)
+
+
+def get_requests_after(last_request_id, limit=500):
+    """
+    Get the requests created after a given request, in creation order.
+
+    :param last_request_id: high-water mark, the identifier of the last processed request
+    :param limit: maximum number of requests to return
+    :return: list of rows with the id, tesla_id and activity_id of each request
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT id, tesla_id, activity_id FROM request WHERE id > :last_request_id ORDER BY id LIMIT :limit"),
+        {'last_request_id': last_request_id, 'limit': limit}).fetchall()
+
+
+def get_learner_ids_after(after_tesla_id=None, limit=500):
+    """
+    Get the TeSLA IDs of the learners after a given one, in TeSLA ID order.
+
+    :param after_tesla_id: TeSLA ID of the last learner of the previous batch, or None for the first batch
+    :param limit: maximum number of learners to return
+    :return: list of learner TeSLA IDs
+    """
+    rows = tesla_db.db.session.execute(text(
+        "SELECT tesla_id FROM learner WHERE :after_tesla_id IS NULL OR tesla_id > :after_tesla_id "
+        "ORDER BY tesla_id LIMIT :limit"),
+        {'after_tesla_id': after_tesla_id, 'limit': limit}).fetchall()
+    return [str(row.tesla_id) for row in rows]
+
+
+def get_activities_after(after_activity_id=0, limit=500):
+    """
+    Get the activities after a given one, in identifier order.
+
+    :param after_activity_id: identifier of the last activity of the previous batch
+    :param limit: maximum number of activities to return
+    :return: list of rows with the id, vle_id, activity_type and activity_id of each activity
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT id, vle_id, activity_type, activity_id FROM activity WHERE id > :after_activity_id "
+        "ORDER BY id LIMIT :limit"),
+        {'after_activity_id': after_activity_id, 'limit': limit}).fetchall()
+
+
+def get_learners(tesla_ids):
+    """
+    Get the consent information of several learners
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: list of rows with the tesla_id, consent_id, consent_accepted and consent_rejected of each learner
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT tesla_id, consent_id, consent_accepted, consent_rejected FROM learner "
+        "WHERE tesla_id IN :tesla_ids").bindparams(bindparam('tesla_ids', expanding=True)),
+        {'tesla_ids': list(tesla_ids)}).fetchall()
+
+
+def get_learner_rows(tesla_ids):
+    """
+    Get all the columns of several learners
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: list of learner rows
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT * FROM learner WHERE tesla_id IN :tesla_ids").bindparams(bindparam('tesla_ids', expanding=True)),
+        {'tesla_ids': list(tesla_ids)}).fetchall()
+
+
+def get_send_categories(tesla_ids):
+    """
+    Get the SEND categories of several learners
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: list of rows with the tesla_id of the learner and the id and encoded data of each category
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT sl.tesla_id, sc.id, sc.data FROM send_learner sl "
+        "JOIN send_category sc ON sc.id = sl.category_id "
+        "WHERE sl.tesla_id IN :tesla_ids").bindparams(bindparam('tesla_ids', expanding=True)),
+        {'tesla_ids': list(tesla_ids)}).fetchall()
+
+
+def get_learner_instrument_enrolment_status(tesla_id, instrument_id):
+    """
+    Get the enrolment status of a learner for an instrument with a single query. Enrolment requests are completed
+    when their result for the instrument is finished (status 2) and pending when it is not started or in progress
+    (status 0 or 1), as counted by tesla_db.learners.count_learner_completed_requests and
+    count_learner_pending_requests. When the enrolment counters are enabled, the counts are read from them.
+
+    :param tesla_id: learner TeSLA ID
+    :param instrument_id: instrument identifier
+    :return: dictionary with the enrolment percentage (None if there is no enrolment) and the number of completed and
+        pending enrolment requests
+    """
+    if ENROLMENT_COUNTERS:
+        query = text(
+            "SELECT le.percentage, c.completed, c.pending "
+            "FROM (SELECT 1 AS one) AS learner_filter "
+            "LEFT JOIN learner_enrolment le ON le.tesla_id = :tesla_id AND le.instrument_id = :instrument_id "
+            "LEFT JOIN learner_enrolment_counter c ON c.tesla_id = :tesla_id AND c.instrument_id = :instrument_id")
+    else:
+        query = text(
+            "SELECT le.percentage, s.completed, s.pending "
+            "FROM (SELECT 1 AS one) AS learner_filter "
+            "LEFT JOIN learner_enrolment le ON le.tesla_id = :tesla_id AND le.instrument_id = :instrument_id "
+            "CROSS JOIN (SELECT SUM(CASE WHEN rr.status = 2 THEN 1 ELSE 0 END) AS completed, "
+            "SUM(CASE WHEN rr.status IN (0, 1) THEN 1 ELSE 0 END) AS pending "
+            "FROM request r JOIN request_result rr ON rr.request_id = r.id AND rr.instrument_id = :instrument_id "
+            "WHERE r.tesla_id = :tesla_id AND r.is_enrolment) AS s")
+
+    row = tesla_db.db.session.execute(query, {'tesla_id': str(tesla_id), 'instrument_id': instrument_id}).first()
+
+    return {'percentage': row.percentage,
+            'completed': int(row.completed or 0),
+            'pending': int(row.pending or 0)}
+
+
+def get_learners_enrolment_percentages(tesla_ids, instrument_ids):
+    """
+    Get the enrolment percentages of several learners for several instruments
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param instrument_ids: list of instrument identifiers
+    :return: list of rows with the tesla_id, instrument_id and percentage of each existing enrolment
+    """
+    return tesla_db.db.session.execute(text(
+        "SELECT tesla_id, instrument_id, percentage FROM learner_enrolment "
+        "WHERE tesla_id IN :tesla_ids AND instrument_id IN :instrument_ids").bindparams(
+        bindparam('tesla_ids', expanding=True), bindparam('instrument_ids', expanding=True)),
+        {'tesla_ids': list(tesla_ids), 'instrument_ids': list(instrument_ids)}).fetchall()
+
+
+def get_learners_enrolment_request_counts(tesla_ids, instrument_ids):
+    """
+    Get the number of completed and pending enrolment requests of several learners for several instruments
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param instrument_ids: list of instrument identifiers
+    :return: list of rows with the tesla_id, instrument_id, completed and pending counts of each pair with requests
+    """
+    if ENROLMENT_COUNTERS:
+        return tesla_db.db.session.execute(text(
+            "SELECT tesla_id, instrument_id, completed, pending FROM learner_enrolment_counter "
+            "WHERE tesla_id IN :tesla_ids AND instrument_id IN :instrument_ids").bindparams(
+            bindparam('tesla_ids', expanding=True), bindparam('instrument_ids', expanding=True)),
+            {'tesla_ids': list(tesla_ids), 'instrument_ids': list(instrument_ids)}).fetchall()
+
+    return tesla_db.db.session.execute(text(
+        "SELECT r.tesla_id, rr.instrument_id, "
+        "SUM(CASE WHEN rr.status = 2 THEN 1 ELSE 0 END) AS completed, "
+        "SUM(CASE WHEN rr.status IN (0, 1) THEN 1 ELSE 0 END) AS pending "
+        "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+        "WHERE r.is_enrolment AND r.tesla_id IN :tesla_ids AND rr.instrument_id IN :instrument_ids "
+        "GROUP BY r.tesla_id, rr.instrument_id").bindparams(
+        bindparam('tesla_ids', expanding=True), bindparam('instrument_ids', expanding=True)),
+        {'tesla_ids': list(tesla_ids), 'instrument_ids': list(instrument_ids)}).fetchall()
+
+
+# Results summary of the learners in an activity, for each instrument
+LEARNERS_SUMMARY_QUERY = (
+    "SELECT r.tesla_id, rr.instrument_id, "
+    "SUM(CASE WHEN rr.status = 2 THEN 1 ELSE 0 END) AS valid, "
+    "SUM(CASE WHEN rr.status = 3 THEN 1 ELSE 0 END) AS failed, "
+    "SUM(CASE WHEN rr.status IN (0, 1) THEN 1 ELSE 0 END) AS pending, "
+    "AVG(CASE WHEN rr.status = 2 THEN rr.value END) AS average, "
+    "MIN(CASE WHEN rr.status = 2 THEN rr.value END) AS min, "
+    "MAX(CASE WHEN rr.status = 2 THEN rr.value END) AS max "
+    "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+    "WHERE r.activity_id = :activity_id AND NOT r.is_enrolment {learner_filter} "
+    "GROUP BY r.tesla_id, rr.instrument_id "
+    "ORDER BY r.tesla_id, rr.instrument_id")
+
+
+def get_activity_learners_summary(activity_id, tesla_ids):
+    """
+    Get the results summary of several learners in an activity, for each instrument, with a single grouped query.
+    Results are valid when they are finished (status 2), failed when they failed (status 3) and pending otherwise.
+    Average, minimum and maximum values are computed from the valid results.
+
+    :param activity_id: activity identifier
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: dictionary with the list of instrument summaries of each learner, ordered by instrument
+    """
+    summaries = dict((str(tesla_id), []) for tesla_id in tesla_ids)
+    if len(summaries) == 0:
+        return summaries
+
+    rows = tesla_db.db.session.execute(text(
+        LEARNERS_SUMMARY_QUERY.format(learner_filter="AND r.tesla_id IN :tesla_ids")).bindparams(
+        bindparam('tesla_ids', expanding=True)),
+        {'activity_id': activity_id, 'tesla_ids': list(summaries.keys())}).fetchall()
+
+    for row in rows:
+        summaries[str(row.tesla_id)].append(row)
+
+    return summaries
+
+
+def iter_activity_learners_summary(activity_id, batch_size=500):
+    """
+    Iterate over the results summary of all the learners in an activity. Rows are read from a server side cursor in
+    batches, so memory usage does not depend on the number of learners.
+
+    :param activity_id: activity identifier
+    :param batch_size: number of rows fetched at once
+    :return: generator of tuples with the TeSLA ID of each learner and the list of its instrument summaries
+    """
+    connection = tesla_db.db.session.connection().execution_options(stream_results=True)
+    result = connection.execute(text(LEARNERS_SUMMARY_QUERY.format(learner_filter="")),
+                                {'activity_id': activity_id})
+    try:
+        tesla_id = None
+        summary = []
+        while True:
+            rows = result.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                if str(row.tesla_id) != tesla_id:
+                    if tesla_id is not None:
+                        yield tesla_id, summary
+                    tesla_id = str(row.tesla_id)
+                    summary = []
+                summary.append(row)
+        if tesla_id is not None:
+            yield tesla_id, summary
+    finally:
+        result.close()
+
+
+def get_activity_learners_after(activity_id, after_tesla_id=None, limit=20, instrument_ids=None):
+    """
+    Get the learners with requests in an activity, ordered by their TeSLA ID. It is used for keyset pagination, so
+    the cost does not depend on the position of the page.
+
+    :param activity_id: activity identifier
+    :param after_tesla_id: TeSLA ID of the last learner of the previous page, or None for the first page
+    :param limit: maximum number of learners to return
+    :param instrument_ids: list of instrument identifiers. Only learners with requests for some of them are returned.
+    :return: list of TeSLA IDs
+    """
+    params = {'activity_id': activity_id, 'limit': limit}
+    after_filter = ""
+    if after_tesla_id is not None:
+        after_filter = "AND tesla_id > :after_tesla_id "
+        params['after_tesla_id'] = str(after_tesla_id)
+    if instrument_ids is not None:
+        after_filter += ("AND EXISTS (SELECT 1 FROM request_result rr WHERE rr.request_id = request.id "
+                         "AND rr.instrument_id IN :instrument_ids) ")
+        params['instrument_ids'] = list(instrument_ids)
+
+    statement = text(
+        "SELECT DISTINCT tesla_id FROM request "
+        "WHERE activity_id = :activity_id AND NOT is_enrolment " + after_filter +
+        "ORDER BY tesla_id LIMIT :limit")
+    if instrument_ids is not None:
+        statement = statement.bindparams(bindparam('instrument_ids', expanding=True))
+
+    rows = tesla_db.db.session.execute(statement, params).fetchall()
+
+    return [str(row.tesla_id) for row in rows]
+
+
+def get_activity_results_version(activity_id):
+    """
+    Get a version stamp for the results of an activity by reading all of them. It is only used when the activity
+    reports, which keep a version for each activity, are not installed. In PostgreSQL, every write of a result row
+    gives it a new transaction id (xmin), whether it is done through the API or directly in the database, so the stamp
+    changes whenever a result of the activity is added, modified or removed. Other databases have no row transaction
+    id, and the stamp is computed from the result identifiers, statuses and values.
+
+    :param activity_id: activity identifier
+    :return: string with the number of results and the aggregates of their row versions
+    """
+    if tesla_db.db.engine.name == 'postgresql':
+        aggregates = "MAX(rr.xmin::text::bigint), SUM(rr.xmin::text::bigint)"
+    else:
+        aggregates = "MAX(rr.id), SUM(rr.status), SUM(rr.value)"
+
+    row = tesla_db.db.session.execute(text(
+        "SELECT COUNT(*), " + aggregates + " "
+        "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+        "WHERE r.activity_id = :activity_id AND NOT r.is_enrolment"), {'activity_id': activity_id}).first()
+
+    return '_'.join(str(value) for value in row)
+
+
+def get_activity_stamp(vle_id, activity_type, activity_id):
+    """
+    Get a version stamp for an activity and its instruments with a single lookup of the activity. It changes whenever
+    the activity or its instruments are modified. Rows are digested as text, which requires PostgreSQL.
+
+    :param vle_id: VLE identifier
+    :param activity_type: type of the activity in the VLE
+    :param activity_id: identifier of the activity in the VLE
+    :return: tuple with the activity identifier and the digests of the activity and its instruments, or None if the
+        activity does not exist
+    """
+    row = tesla_db.db.session.execute(text(
+        "SELECT a.id, md5(a::text), "
+        "(SELECT md5(string_agg(ai::text, ',' ORDER BY ai::text)) FROM activity_instrument ai "
+        "WHERE ai.activity_id = a.id) "
+        "FROM activity a "
+        "WHERE a.vle_id = :vle_id AND a.activity_type = :activity_type AND a.activity_id = :activity_id"),
+        {'vle_id': vle_id, 'activity_type': activity_type, 'activity_id': activity_id}).first()
+    if row is None:
+        return None
+
+    return tuple(str(value) for value in row)
+
+
+def is_activity_tesla_active(activity_id):
+    """
+    Check if an activity has some active instrument
+
+    :param activity_id: activity identifier
+    """
+    return bool(tesla_db.db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM activity_instrument WHERE activity_id = :activity_id AND active)"),
+        {'activity_id': activity_id}).scalar())
+
+
+def get_learners_valid_results_histograms(tesla_ids, instrument_ids, bins=10):
+    """
+    Get the histogram of the valid results of several learners for several instruments with a single grouped query.
+    Values between 0 and 1 are distributed in bins of the same width, and values of 1 are in the last bin.
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param instrument_ids: list of instrument identifiers
+    :param bins: number of bins of the histograms
+    :return: dictionary with the list of counts for each (tesla_id, instrument_id) pair
+    """
+    histograms = dict(((str(tesla_id), instrument_id), [0] * bins)
+                      for tesla_id in tesla_ids for instrument_id in instrument_ids)
+    if len(histograms) == 0:
+        return histograms
+
+    rows = tesla_db.db.session.execute(text(
+        "SELECT r.tesla_id, rr.instrument_id, "
+        "LEAST(GREATEST(CAST(FLOOR(rr.value * :bins) AS INTEGER), 0), :bins - 1) AS bin, "
+        "COUNT(*) AS total "
+        "FROM request r JOIN request_result rr ON rr.request_id = r.id "
+        "WHERE rr.status = 2 AND NOT r.is_enrolment "
+        "AND r.tesla_id IN :tesla_ids AND rr.instrument_id IN :instrument_ids "
+        "GROUP BY r.tesla_id, rr.instrument_id, bin").bindparams(
+        bindparam('tesla_ids', expanding=True), bindparam('instrument_ids', expanding=True)),
+        {'bins': bins, 'tesla_ids': list(set(str(tesla_id) for tesla_id in tesla_ids)),
+         'instrument_ids': list(instrument_ids)}).fetchall()
+
+    for row in rows:
+        histograms[(str(row.tesla_id), row.instrument_id)][row.bin] = int(row.total)
+
+    return histograms
+
+
+@contextmanager
+def advisory_lock(key):
+    """
+    Hold a PostgreSQL advisory lock for the given key, serializing its holders across processes. A dedicated
+    connection is used, so commits done while the lock is held do not release it. With other database engines this
+    context manager does nothing.
+
+    :param key: hashable object identifying the lock
+    """
+    engine = tesla_db.db.engine
+    if engine.name != 'postgresql':
+        yield
+        return
+
+    lock_id = zlib.crc32(repr(key).encode('utf-8'))
+    connection = engine.connect()
+    try:
+        connection.execute(text("SELECT pg_advisory_lock(:lock_id)"), {'lock_id': lock_id})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {'lock_id': lock_id})
+    finally:
+        connection.close()
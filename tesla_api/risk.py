@@ -0,0 +1,237 @@
+"""
+TeSLA learner risk levels
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from itertools import chain
+
+import numpy as np
+import tesla_models.schemas as schemas
+
+HISTOGRAM_BINS = 10
+EPSILON = 0.00000001
+
+
+def get_instrument_properties(instrument_id):
+    """
+    Get the properties used to compute the risk levels of an instrument.
+
+    :param instrument_id: instrument identifier
+    :return: tuple with the polarity, the auth, content and security flags and the summary variable
+    """
+    # TODO: Put polarity in instrument fields
+    polarity = 1
+    if instrument_id in [2, 3, 6]:
+        polarity = -1
+
+    # TODO: Put properties in instrument fields
+    if instrument_id in [1, 3, 5]:
+        return polarity, True, False, False, 'average'
+    if instrument_id in [7]:
+        return polarity, True, True, False, 'min'
+    if instrument_id in [2, 3]:
+        return polarity, False, False, True, 'max'
+    if instrument_id in [6]:
+        return polarity, False, True, False, 'max'
+    return polarity, False, False, False, 'average'
+
+
+def get_learners_instrument_stats(learner_results, context_statistics, histograms):
+    """
+    Compute the instrument statistics and risk levels of a list of learners. The computation is done for all the
+    learners at once over (learners x instruments x bins) arrays, and gives the same values as computing each learner
+    with reports._get_learner_instrument_stats.
+
+    :param learner_results: list of learner results, with the tesla_id and the instruments summary of each learner
+    :param context_statistics: dictionary with the histogram and thresholds of each instrument in the activity
+    :param histograms: dictionary with the valid results histogram of each (tesla_id, instrument_id)
+    :return: list with the statistics of each learner, in the same order
+    """
+    instrument_ids = list(context_statistics.keys())
+    num_learners = len(learner_results)
+    num_instruments = len(instrument_ids)
+
+    properties = [get_instrument_properties(instrument_id) for instrument_id in instrument_ids]
+    polarity = np.array([prop[0] for prop in properties], dtype=np.int64)
+    categories = np.array([prop[1:4] for prop in properties], dtype=bool).reshape(num_instruments, 3)
+
+    context_hist = np.zeros((num_instruments, HISTOGRAM_BINS), dtype=np.int64)
+    has_thresholds = np.zeros(num_instruments, dtype=bool)
+    medium = np.zeros(num_instruments, dtype=np.float64)
+    thresholds_json = []
+    for idx, instrument_id in enumerate(instrument_ids):
+        context_hist[idx] = context_statistics[instrument_id]['histogram']
+        thresholds = context_statistics[instrument_id]['thresholds']
+        if thresholds is not None:
+            has_thresholds[idx] = True
+            medium[idx] = thresholds['medium']
+        thresholds_json.append(schemas.InstrumentThreshold().dump(thresholds).data)
+
+    # Gather the learners data as arrays
+    empty_histogram = [0] * HISTOGRAM_BINS
+    has_data = []
+    valid = []
+    failed = []
+    value = []
+    hist = []
+    learner_histograms = []
+    for learner_result in learner_results:
+        tesla_id = str(learner_result['tesla_id'])
+        instruments = learner_result['instruments']
+        histograms_row = []
+        for instrument_id, prop in zip(instrument_ids, properties):
+            instrument = instruments.get(instrument_id)
+            if instrument is None:
+                has_data.append(False)
+                valid.append(0)
+                failed.append(0)
+                value.append(0.0)
+                hist.append(empty_histogram)
+                histograms_row.append([])
+            else:
+                histogram = histograms[(tesla_id, instrument_id)]
+                has_data.append(True)
+                valid.append(instrument['valid'])
+                failed.append(instrument['failed'])
+                value.append(instrument[prop[4]])
+                hist.append(histogram)
+                histograms_row.append(histogram)
+        learner_histograms.append(histograms_row)
+
+    shape = (num_learners, num_instruments)
+    has_data = np.array(has_data, dtype=bool).reshape(shape)
+    valid = np.array(valid, dtype=np.int64).reshape(shape)
+    failed = np.array(failed, dtype=np.int64).reshape(shape)
+    value = np.array(value, dtype=np.float64).reshape(shape)
+    hist = np.fromiter(chain.from_iterable(hist), dtype=np.int64,
+                       count=num_learners * num_instruments * HISTOGRAM_BINS).reshape(shape + (HISTOGRAM_BINS,))
+
+    confidence = valid / ((valid + failed) + EPSILON)
+    computed = has_data & (confidence >= 0.5)
+
+    result_bean = np.where(value < 1.0, np.floor(value * 10.0), HISTOGRAM_BINS - 1).astype(np.int64)
+    result_bean = np.clip(result_bean, 0, HISTOGRAM_BINS - 1)
+
+    prob_learner, h_prob_learner = _get_probabilities(hist, result_bean, polarity)
+
+    # The context is the same for all the learners, so its probabilities are computed once for each bin
+    all_beans = np.broadcast_to(np.arange(HISTOGRAM_BINS), (num_instruments, HISTOGRAM_BINS))
+    context_prob, context_h_prob = _get_probabilities(context_hist[:, np.newaxis, :].repeat(HISTOGRAM_BINS, axis=1),
+                                                      all_beans, polarity[:, np.newaxis])
+    instrument_index = np.arange(num_instruments)
+    prob_context = context_prob[instrument_index, result_bean]
+    h_prob_context = context_h_prob[instrument_index, result_bean]
+
+    # Build final recomendation
+    green = np.where(polarity > 0, value > medium, (1.0 - value) > medium) & has_thresholds
+    level = np.select(
+        [green,
+         ~has_thresholds & (h_prob_learner < 0.4) & (h_prob_context < 0.4),
+         h_prob_learner > 0.75,
+         h_prob_context < 0.5],
+        [3, 3, 1, 2], default=1)
+    level = np.where(computed, level, np.where(has_data, 2, 0))
+
+    # Compute the final levels of each category
+    category_levels = []
+    for c_idx in range(3):
+        in_category = categories[:, c_idx]
+        count = int(in_category.sum())
+        if count == 0:
+            category_levels.append([0] * num_learners)
+            continue
+        levels = level[:, in_category]
+        positive = (levels == 3).any(axis=1)
+        negative = (levels == 1).any(axis=1)
+        mean_level = np.floor(levels.sum(axis=1) / count).astype(np.int64)
+        category_levels.append(np.select(
+            [positive & negative, negative, positive], [2, 1, 3], default=mean_level).tolist())
+
+    # Convert to the report structure
+    has_data = has_data.tolist()
+    computed = computed.tolist()
+    confidence = confidence.tolist()
+    level = level.tolist()
+    result_bean = result_bean.tolist()
+    prob_learner = prob_learner.tolist()
+    prob_context = prob_context.tolist()
+    h_prob_learner = h_prob_learner.tolist()
+    h_prob_context = h_prob_context.tolist()
+    polarity = polarity.tolist()
+
+    learners_stats = []
+    for l_idx in range(num_learners):
+        rows = zip(instrument_ids, polarity, thresholds_json, learner_histograms[l_idx], has_data[l_idx],
+                   computed[l_idx], confidence[l_idx], level[l_idx], prob_learner[l_idx], prob_context[l_idx],
+                   h_prob_learner[l_idx], h_prob_context[l_idx], result_bean[l_idx])
+        instruments_stats = {}
+        for (instrument_id, i_polarity, i_thresholds, i_histogram, i_has_data, i_computed, i_confidence, i_level,
+             i_prob_learner, i_prob_context, i_h_prob_learner, i_h_prob_context, i_result_bean) in rows:
+            if not i_computed:
+                i_prob_learner = 0.0
+                i_prob_context = 0.0
+                i_h_prob_learner = 1.0
+                i_h_prob_context = 1.0
+                i_result_bean = None
+            if not i_has_data:
+                i_confidence = 0.0
+                i_level = 0.0
+            instruments_stats[instrument_id] = {
+                'prob_learner': i_prob_learner,
+                'prob_context': i_prob_context,
+                'h_prob_learner': i_h_prob_learner,
+                'h_prob_context': i_h_prob_context,
+                'confidence': i_confidence,
+                'level': i_level,
+                'instrument_polarity': i_polarity,
+                'histogram': i_histogram,
+                'result_bean': i_result_bean,
+                'thresholds': i_thresholds
+            }
+
+        learners_stats.append({
+            'instruments': instruments_stats,
+            'levels': {
+                'auth': category_levels[0][l_idx],
+                'content': category_levels[1][l_idx],
+                'security': category_levels[2][l_idx]
+            }
+        })
+
+    return learners_stats
+
+
+def _get_probabilities(hist, result_bean, polarity):
+    """
+    Compute the probability of the result bin, weighting the neighbour bins by half, and the probability of the bins
+    on the good side of the result bin, according to the instrument polarity.
+    """
+    total = hist.sum(axis=-1) + EPSILON
+
+    padded = np.pad(hist, [(0, 0)] * (hist.ndim - 1) + [(1, 1)], mode='constant')
+    index = result_bean[..., np.newaxis]
+    previous_bin = np.take_along_axis(padded, index, axis=-1)[..., 0]
+    current_bin = np.take_along_axis(padded, index + 1, axis=-1)[..., 0]
+    next_bin = np.take_along_axis(padded, index + 2, axis=-1)[..., 0]
+    prob = (0.5 * previous_bin + current_bin + 0.5 * next_bin) / total
+
+    cumulative = np.cumsum(hist, axis=-1)
+    below = np.take_along_axis(cumulative, index, axis=-1)[..., 0] - current_bin
+    above = cumulative[..., -1] - below - current_bin
+    h_prob = np.where(polarity > 0, above, below) / total
+
+    return prob, h_prob
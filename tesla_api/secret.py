@@ -15,29 +15,80 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from OpenSSL import crypto
-from tesla_api import logger, tesla_db, utils
+import re
+from tesla_api import logger, catalog, utils
 
 AUTHORIZED_CLIENTS = ['tep', 'rt']
 
 
-def get_instrument_from_cert(request):
+def get_client_cert_identity(request):
+    """
+    Get the identity of the client certificate from the parameters set by nginx after verifying it. This is only
+    used when TRUST_PROXY_CERT_HEADERS is enabled, otherwise the PEM certificate is parsed.
+
+    :param request: current request
+    :return: dictionary with the cn and fingerprint of the certificate, or None if not available
+    """
+    if not bool(int(os.getenv('TRUST_PROXY_CERT_HEADERS', 0))):
+        return None
+
+    if request.environ.get('HTTP_X_SSL_CLIENT_VERIFY', None) != 'SUCCESS':
+        return None
+
+    cn = get_dn_cn(request.environ.get('HTTP_X_SSL_CLIENT_S_DN', None))
+    if cn is None:
+        return None
+
+    return {'cn': cn, 'fingerprint': request.environ.get('HTTP_X_SSL_CLIENT_FINGERPRINT', None)}
+
+
+def get_dn_cn(dn):
+    """
+    Extract the common name from a distinguished name as provided by nginx, either in RFC 2253 format
+    (CN=name,O=org,C=ES) or in the legacy format (/C=ES/O=org/CN=name).
+    """
+    if not dn:
+        return None
+
+    if dn.startswith('/'):
+        attributes = dn[1:].split('/')
+    else:
+        attributes = re.split(r'(?<!\\),', dn)
+
+    for attribute in attributes:
+        name, sep, value = attribute.strip().partition('=')
+        if sep and name.upper() == 'CN':
+            return value.replace('\\', '')
+
+    return None
+
+
+def get_client_cert_cn(request):
+
+    identity = get_client_cert_identity(request)
+    if identity is not None:
+        return identity['cn']
 
     cert = request.environ.get('HTTP_X_SSL_CERT', None)
 
     if cert is None:
         return None
 
-    cert = cert + '\n'
-    cert = cert.replace('\n\t', '\n')
+    return utils.get_cert_cn(cert)
+
 
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+def get_instrument_from_cert(request):
 
-    subject = cert.get_subject().CN.upper()
+    cn = get_client_cert_cn(request)
+
+    if cn is None:
+        return None
+
+    subject = cn.upper()
 
     acronym = subject.split('-')[0]
 
-    return tesla_db.instruments.get_instrument_by_acronym(acronym)
+    return catalog.get_instrument_by_acronym(acronym)
 
 
 def get_module_from_cert(request):
@@ -48,22 +99,23 @@ def get_module_from_cert(request):
         logger.warning('ALLOW_DEBUG_HEADER_CN enabled. Disable in production environment.')
         return utils.get_cert_module_debug(cert)
 
+    identity = get_client_cert_identity(request)
+    if identity is not None:
+        return utils.get_cert_module_from_identity(identity['cn'], identity['fingerprint'])
+
     return utils.get_cert_module(cert)
 
 
 def validate_client_cert(cert, authorized=AUTHORIZED_CLIENTS):
-    cert = cert + '\n'
-    cert = cert.replace('\n\t', '\n')
-
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
 
     # logging.info('cert info: ' + str(cert))
 
-    subject = cert.get_subject()
+    return validate_client_cn(utils.get_cert_cn(cert), authorized)
+
 
-    # logging.info('subject: ' + str(subject))
+def validate_client_cn(cn, authorized=AUTHORIZED_CLIENTS):
 
-    issued_to = subject.CN.lower()
+    issued_to = cn.lower()
 
     # logging.info('issued_to: ' + str(issued_to))
 
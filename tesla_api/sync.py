@@ -0,0 +1,316 @@
+"""
+TeSLA TEP synchronization helpers
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, current_app
+from tesla_models import tep_db
+from tesla_api import tesla_db, logger, cache, queries
+from tesla_api.caching import TTLCache, SingleFlight
+
+# Synchronization mode. With 'inline', TEP data is synchronized on the request path. With 'mirror', learners and
+# activities are served from the database, and the synchronization worker (bin/run_sync_worker.py) refreshes them and
+# the instrument thresholds in background. Only learners and activities not found in the database are synchronized
+# inline. Informed consent changes are picked up when the worker refreshes the learner.
+SYNC_MODE = os.getenv('TEP_SYNC_MODE', 'inline')
+
+# Synchronized activity identifiers, indexed by (vle_id, activity_type, activity_id). Expired entries are still
+# served while a background synchronization refreshes them.
+activity_cache = TTLCache(maxsize=int(os.getenv('TEP_ACTIVITY_CACHE_SIZE', 4096)),
+                          ttl=int(os.getenv('TEP_ACTIVITY_CACHE_TTL', 60)))
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Learners and activities not found in the TEP, to avoid repeating the synchronization for unknown identifiers
+negative_cache = TTLCache(maxsize=int(os.getenv('TEP_NEGATIVE_CACHE_SIZE', 8192)),
+                          ttl=int(os.getenv('TEP_NEGATIVE_CACHE_TTL', 30)))
+
+# Concurrent synchronizations of the same learner or activity wait for a single execution. When enabled, an advisory
+# lock also coalesces the synchronizations of different worker processes.
+sync_flight = SingleFlight()
+ADVISORY_LOCK = bool(int(os.getenv('SINGLE_FLIGHT_ADVISORY_LOCK', 0)))
+ADVISORY_LOCK_SHARE_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_SHARE_TIMEOUT', 5))
+
+# Report the number of calls avoided by request memoization in the X-TeSLA-Avoided-Calls response header
+DEBUG_AVOIDED_CALLS = bool(int(os.getenv('DEBUG_AVOIDED_CALLS', 0)))
+
+
+def request_memoize(fn):
+    """
+    Memoize a function during the current request. Each combination of function and arguments is executed at most
+    once per request, and the number of avoided calls is counted. Empty results are not stored, and calls with
+    non hashable arguments or outside a request are not memoized.
+    """
+    @wraps(fn)
+    def memoized(*args):
+        if not has_request_context():
+            return fn(*args)
+
+        key = (fn.__name__,) + tuple([str(arg) if isinstance(arg, uuid.UUID) else arg for arg in args])
+        try:
+            hash(key)
+        except TypeError:
+            return fn(*args)
+
+        memo = g.setdefault('tesla_memo', {})
+        if key in memo:
+            avoided = g.setdefault('tesla_memo_avoided', {})
+            avoided[fn.__name__] = avoided.get(fn.__name__, 0) + 1
+            return memo[key]
+
+        value = fn(*args)
+        if value is not None:
+            memo[key] = value
+
+        return value
+
+    return memoized
+
+
+def forget_request_memo():
+    """
+    Remove all the memoized values of the current request. It must be used when the request modifies data already
+    memoized.
+    """
+    if has_request_context():
+        g.pop('tesla_memo', None)
+
+
+def get_avoided_calls():
+    """
+    Get the number of calls avoided during the current request, for each memoized function.
+    """
+    if not has_request_context():
+        return {}
+    return dict(g.get('tesla_memo_avoided', {}))
+
+
+def log_avoided_calls(response):
+    """
+    After request handler that reports the calls avoided during the request. They are added as a response header only
+    when DEBUG_AVOIDED_CALLS is enabled.
+    """
+    avoided = get_avoided_calls()
+    if len(avoided) > 0:
+        logger.debug('Avoided duplicated calls: {}'.format(avoided))
+        if DEBUG_AVOIDED_CALLS:
+            response.headers['X-TeSLA-Avoided-Calls'] = str(sum(avoided.values()))
+
+    return response
+
+
+def inline_sync():
+    return SYNC_MODE != 'mirror'
+
+
+@request_memoize
+def sync_learner(tesla_id):
+    tesla_id = str(tesla_id)
+    if not inline_sync():
+        learner = tesla_db.learners.get_learner(tesla_id)
+        if learner is not None:
+            return learner
+
+    if negative_cache.get(('learner', tesla_id)) is not None:
+        return None
+
+    if sync_flight.do(('learner', tesla_id), _sync_learner, tesla_id) is None:
+        negative_cache.set(('learner', tesla_id), True)
+        return None
+
+    return tesla_db.learners.get_learner(tesla_id)
+
+
+def sync_learners(tesla_ids, is_current=None):
+    """
+    Synchronize several learners, reading all of them from the database with a single query. Only the learners not
+    found in the database are synchronized with the TEP in mirror mode. In inline mode, the learners with a current
+    informed consent are not synchronized either, so their consent changes are picked up by the single learner
+    endpoints, which always synchronize the learner.
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param is_current: function that tells if the informed consent of a learner row is current. Without it, all the
+        learners are synchronized in inline mode.
+    :return: dictionary with the learner row of each existing learner
+    """
+    tesla_ids = set(str(tesla_id) for tesla_id in tesla_ids)
+    if len(tesla_ids) == 0:
+        return {}
+
+    learners = dict((str(learner.tesla_id), learner) for learner in queries.get_learners(tesla_ids))
+    if inline_sync():
+        learners = dict((tesla_id, learner) for tesla_id, learner in learners.items()
+                        if is_current is not None and is_current(learner))
+
+    synced = []
+    for tesla_id in tesla_ids:
+        if tesla_id in learners or negative_cache.get(('learner', tesla_id)) is not None:
+            continue
+        if sync_flight.do(('learner', tesla_id), _sync_learner, tesla_id) is None:
+            negative_cache.set(('learner', tesla_id), True)
+            continue
+        synced.append(tesla_id)
+
+    if len(synced) > 0:
+        learners.update((str(learner.tesla_id), learner) for learner in queries.get_learners(synced))
+
+    return learners
+
+
+def _sync_learner(tesla_id):
+    key = ('learner', tesla_id)
+    with _coalesce_processes(key) as synced:
+        if synced.value is None:
+            synced.value = tep_db.sync_learner(tesla_id) is not None
+
+    return synced.value or None
+
+
+@request_memoize
+def sync_activity(vle_id, activity_id, activity_type):
+    key = (vle_id, activity_type, activity_id)
+    if negative_cache.get(('activity',) + key) is not None:
+        return None
+
+    if not inline_sync():
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        if activity is not None:
+            return activity
+
+    activity_pk, fresh = activity_cache.peek(key)
+    if activity_pk is not None:
+        if not fresh:
+            _refresh_activity(key)
+        activity = tesla_db.activities.get_activity(activity_pk)
+        if activity is not None:
+            return activity
+        activity_cache.invalidate(key)
+
+    activity_pk = sync_flight.do(('activity',) + key, _sync_activity_pk, vle_id, activity_id, activity_type)
+    if activity_pk is None:
+        negative_cache.set(('activity',) + key, True)
+        return None
+
+    return tesla_db.activities.get_activity(activity_pk)
+
+
+def _sync_activity_pk(vle_id, activity_id, activity_type):
+    key = (vle_id, activity_type, activity_id)
+    with _coalesce_processes(('activity',) + key) as synced:
+        if synced.value is None:
+            activity = tep_db.sync_activity(vle_id, activity_id, activity_type)
+            if activity is not None:
+                synced.value = activity.id
+
+    if synced.value is not None:
+        activity_cache.set(key, synced.value)
+    else:
+        activity_cache.invalidate(key)
+
+    return synced.value
+
+
+class _SyncResult(object):
+    def __init__(self):
+        self.value = None
+
+
+@contextmanager
+def _coalesce_processes(key):
+    """
+    Hold the advisory lock of a synchronization key. The result is shared for a few seconds through the application
+    cache, so the processes that waited for the lock find the result of the process that held it.
+    """
+    synced = _SyncResult()
+    if not ADVISORY_LOCK:
+        yield synced
+        return
+
+    cache_key = 'tesla_sync_{}'.format('_'.join([str(part) for part in key]))
+    with queries.advisory_lock(key):
+        synced.value = cache.get(cache_key)
+        yield synced
+        if synced.value is not None:
+            cache.set(cache_key, synced.value, timeout=ADVISORY_LOCK_SHARE_TIMEOUT)
+
+
+def _refresh_activity(key):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    thread = threading.Thread(target=_refresh_activity_worker, args=(current_app._get_current_object(), key))
+    thread.daemon = True
+    thread.start()
+
+
+def _refresh_activity_worker(app, key):
+    vle_id, activity_type, activity_id = key
+    try:
+        with app.app_context():
+            sync_flight.do(('activity',) + key, _sync_activity_pk, vle_id, activity_id, activity_type)
+    except Exception:
+        logger.exception('Error refreshing activity {}'.format(key))
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def invalidate_activity(vle_id, activity_type, activity_id):
+    """
+    Remove a synchronized activity from the caches. It must be called when the activity is created or modified.
+    """
+    activity_cache.invalidate((vle_id, activity_type, activity_id))
+    negative_cache.invalidate(('activity', vle_id, activity_type, activity_id))
+
+
+def invalidate_learner(tesla_id):
+    """
+    Remove a learner from the caches. It must be called when the learner is created or modified.
+    """
+    negative_cache.invalidate(('learner', str(tesla_id)))
+
+
+def get_stats():
+    """
+    Get the statistics of the synchronization caches. Hits of the negative cache are synchronizations avoided for
+    unknown learners and activities.
+    """
+    return {'activities': activity_cache.stats(),
+            'negative': negative_cache.stats(),
+            'single_flight': sync_flight.stats()}
+
+
+@request_memoize
+def get_learner(tesla_id):
+    return tesla_db.learners.get_learner(tesla_id)
+
+
+@request_memoize
+def get_activity_by_def(vle_id, activity_type, activity_id):
+    return tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+
+
+@request_memoize
+def get_activity(activity_id):
+    return tesla_db.activities.get_activity(activity_id)
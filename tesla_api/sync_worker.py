@@ -0,0 +1,143 @@
+"""
+TeSLA TEP synchronization worker
+"""
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+from tesla_models import tep_db
+from tesla_api import app, tesla_db, logger, queries
+
+# Time between synchronization cycles, in seconds
+SYNC_INTERVAL = int(os.getenv('TEP_SYNC_INTERVAL', 30))
+
+# Maximum number of requests processed on each cycle
+SYNC_BATCH_SIZE = int(os.getenv('TEP_SYNC_BATCH_SIZE', 500))
+
+# Maximum number of known learners and activities refreshed on each cycle. All of them are refreshed in turn, so an
+# informed consent change in the TEP is mirrored after at most (learners / TEP_SYNC_REFRESH_SIZE) cycles.
+SYNC_REFRESH_SIZE = int(os.getenv('TEP_SYNC_REFRESH_SIZE', 200))
+
+# File storing the high-water mark, the identifier of the last processed request
+SYNC_STATE_FILE = os.getenv('TEP_SYNC_STATE_FILE', '/app/data/tep_sync.state')
+
+
+def load_high_water_mark():
+    if not os.path.isfile(SYNC_STATE_FILE):
+        return 0
+
+    with open(SYNC_STATE_FILE, 'r') as state_file:
+        content = state_file.read().strip()
+        if len(content) == 0:
+            return 0
+        return int(content)
+
+
+def save_high_water_mark(last_request_id):
+    tmp_filename = SYNC_STATE_FILE + '.tmp'
+    with open(tmp_filename, 'w') as state_file:
+        state_file.write(str(last_request_id))
+    os.replace(tmp_filename, SYNC_STATE_FILE)
+
+
+def sync_cycle(last_request_id, refresh_position=None):
+    """
+    Mirror the TEP data served by the API in mirror mode. Instrument thresholds are always synchronized, the learners
+    and activities of new requests are synchronized, and a batch of the other known learners and activities is
+    refreshed, continuing from the previous cycle.
+
+    :param last_request_id: high-water mark of the previous cycle
+    :param refresh_position: refresh position returned by the previous cycle, or None to start from the beginning
+    :return: tuple with the new high-water mark and the new refresh position
+    """
+    tep_db.sync_instrument_thresholds()
+
+    requests = queries.get_requests_after(last_request_id, SYNC_BATCH_SIZE)
+    while len(requests) > 0:
+        learners = set()
+        activities = set()
+        for request in requests:
+            if request.tesla_id is not None:
+                learners.add(str(request.tesla_id))
+            if request.activity_id is not None:
+                activities.add(request.activity_id)
+
+        for tesla_id in learners:
+            tep_db.sync_learner(tesla_id)
+
+        for activity_pk in activities:
+            activity = tesla_db.activities.get_activity(activity_pk)
+            if activity is not None:
+                tep_db.sync_activity(activity.vle_id, activity.activity_id, activity.activity_type)
+
+        last_request_id = requests[-1].id
+        save_high_water_mark(last_request_id)
+        logger.info('TEP synchronization: {} learners and {} activities up to request {}'.format(
+            len(learners), len(activities), last_request_id))
+
+        requests = queries.get_requests_after(last_request_id, SYNC_BATCH_SIZE)
+
+    return last_request_id, refresh_cycle(refresh_position)
+
+
+def refresh_cycle(refresh_position=None):
+    """
+    Refresh the next batch of known learners and activities, so TEP changes of learners and activities without new
+    requests, like informed consent revocations, are also mirrored.
+
+    :param refresh_position: tuple with the last refreshed learner TeSLA ID and activity identifier, or None
+    :return: new refresh position. Each part goes back to the beginning after the last learner or activity.
+    """
+    last_tesla_id, last_activity_id = refresh_position or (None, 0)
+
+    tesla_ids = queries.get_learner_ids_after(last_tesla_id, SYNC_REFRESH_SIZE)
+    for tesla_id in tesla_ids:
+        tep_db.sync_learner(tesla_id)
+
+    activities = queries.get_activities_after(last_activity_id, SYNC_REFRESH_SIZE)
+    for activity in activities:
+        tep_db.sync_activity(activity.vle_id, activity.activity_id, activity.activity_type)
+
+    if len(tesla_ids) > 0 or len(activities) > 0:
+        logger.debug('TEP refresh: {} learners and {} activities'.format(len(tesla_ids), len(activities)))
+
+    return (tesla_ids[-1] if len(tesla_ids) == SYNC_REFRESH_SIZE else None,
+            activities[-1].id if len(activities) == SYNC_REFRESH_SIZE else 0)
+
+
+def run(once=False):
+    """
+    Run the synchronization worker.
+
+    :param once: run a single cycle, when the worker is scheduled externally
+    """
+    last_request_id = load_high_water_mark()
+    refresh_position = None
+    logger.info('TEP synchronization worker started from request {}'.format(last_request_id))
+
+    while True:
+        start = time.time()
+        try:
+            with app.app_context():
+                last_request_id, refresh_position = sync_cycle(last_request_id, refresh_position)
+        except Exception:
+            logger.exception('Error in TEP synchronization cycle')
+
+        if once:
+            break
+
+        time.sleep(max(0.0, SYNC_INTERVAL - (time.time() - start)))
@@ -0,0 +1,94 @@
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import uuid
+
+from sqlalchemy import MetaData, Table, text, bindparam
+from tesla_api import tesla_db
+
+# Values used for the required columns that are not given, by their Python type
+_DEFAULT_VALUES = {
+    bool: False,
+    int: 0,
+    float: 0.0,
+    str: '',
+    datetime.datetime: datetime.datetime(2019, 1, 1),
+    datetime.date: datetime.date(2019, 1, 1),
+    uuid.UUID: uuid.UUID(int=0),
+}
+
+
+def insert_row(table_name, **values):
+    """
+    Insert a row in the test database. Required columns without a default are filled with a value of their type,
+    so tests only give the columns they check.
+
+    :param table_name: name of the table
+    :param values: values of the columns
+    :return: primary key of the new row
+    """
+    session = tesla_db.db.session
+    table = Table(table_name, MetaData(), autoload_with=session.connection())
+    for column in table.columns:
+        if column.name in values or column.nullable or column.server_default is not None:
+            continue
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = str
+        values[column.name] = _DEFAULT_VALUES.get(python_type, '')
+
+    result = session.execute(table.insert().values(**values))
+    return result.inserted_primary_key[0]
+
+
+def insert_activity_results(activity_id, results):
+    """
+    Insert and commit the results of several learners in an activity. Each result is a new request, so they are
+    visible to the requests made with the test client.
+
+    :param activity_id: activity identifier
+    :param results: list of tuples with the tesla_id, instrument_id, status and value of each result
+    """
+    for tesla_id in sorted(set(str(result[0]) for result in results)):
+        if tesla_db.learners.get_learner(tesla_id) is None:
+            insert_row('learner', tesla_id=tesla_id)
+    for tesla_id, instrument_id, status, value in results:
+        request_id = insert_row('request', tesla_id=str(tesla_id), activity_id=activity_id, is_enrolment=False)
+        insert_row('request_result', request_id=request_id, instrument_id=instrument_id, status=status, value=value)
+    tesla_db.db.session.commit()
+
+
+def delete_activity_results(activity_id, tesla_ids):
+    """
+    Delete and commit the results inserted with insert_activity_results, and their learners.
+
+    :param activity_id: activity identifier
+    :param tesla_ids: list of learner TeSLA IDs
+    """
+    session = tesla_db.db.session
+    params = {'activity_id': activity_id, 'tesla_ids': [str(tesla_id) for tesla_id in tesla_ids]}
+    session.execute(text(
+        "DELETE FROM request_result WHERE request_id IN "
+        "(SELECT id FROM request WHERE activity_id = :activity_id AND tesla_id IN :tesla_ids)").bindparams(
+        bindparam('tesla_ids', expanding=True)), params)
+    session.execute(text(
+        "DELETE FROM request WHERE activity_id = :activity_id AND tesla_id IN :tesla_ids").bindparams(
+        bindparam('tesla_ids', expanding=True)), params)
+    session.execute(text(
+        "DELETE FROM learner WHERE tesla_id IN :tesla_ids").bindparams(bindparam('tesla_ids', expanding=True)), params)
+    session.commit()
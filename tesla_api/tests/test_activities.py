@@ -111,6 +111,71 @@ def test_activity_update_activity(base_api_url, app, client_with_certificate_tip
     assert (response_json['description'] == "test description CHANGED")
 
 
+def test_activity_conditional_get(base_api_url, app, client_with_certificate_tip):
+    """ Check a conditional request made after the activity is modified gets the new activity """
+    from tesla_api import tesla_db
+
+    random_number = str(datetime.datetime.now())
+    random_type = "test_type_"+str(random_number)
+    data = json.dumps({"vle_id": 1, "activity_type": str(random_type), "activity_id": str(random_number), "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+    url = base_api_url+str("activities")+"/1/"+str(random_type)+"/"+str(random_number)
+
+    response = client_with_certificate_tip.get(url)
+    assert (response.status_code == 200)
+    etag = response.headers['ETag']
+
+    response = client_with_certificate_tip.get(url, headers={'If-None-Match': etag})
+    assert (response.status_code == 304)
+
+    # Modified through the API
+    data = json.dumps({"vle_id": 1, "activity_type": str(random_type), "activity_id": str(random_number), "description": "test description CHANGED", "conf": ""})
+    response = client_with_certificate_tip.put(url, data=data, content_type='application/json')
+    assert (response.status_code == 200)
+
+    response = client_with_certificate_tip.get(url, headers={'If-None-Match': etag})
+    assert (response.status_code == 200)
+    assert (response.get_json()['description'] == "test description CHANGED")
+    assert (response.headers['ETag'] != etag)
+    etag = response.headers['ETag']
+
+    # Modified in the database, as another worker process would do
+    with app.app_context():
+        activity = tesla_db.activities.get_activity_by_def(1, random_type, random_number)
+        tesla_db.activities.update_activity_description(activity.id, "test description CHANGED AGAIN")
+        tesla_db.db.session.commit()
+
+    response = client_with_certificate_tip.get(url, headers={'If-None-Match': etag})
+    assert (response.status_code == 200)
+    assert (response.get_json()['description'] == "test description CHANGED AGAIN")
+    assert (response.headers['ETag'] != etag)
+
+
+def test_activity_conditional_get_before_sync(base_api_url, app, client_with_certificate_tip, monkeypatch):
+    """ Check a conditional request matching the activity version is answered without synchronizing the activity """
+    from tesla_api import sync
+
+    random_number = str(datetime.datetime.now())
+    random_type = "test_type_"+str(random_number)
+    data = json.dumps({"vle_id": 1, "activity_type": str(random_type), "activity_id": str(random_number), "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+    url = base_api_url+str("activities")+"/1/"+str(random_type)+"/"+str(random_number)
+
+    for resource_url in [url, url+"/instruments"]:
+        response = client_with_certificate_tip.get(resource_url)
+        assert (response.status_code == 200)
+        etag = response.headers['ETag']
+
+        synced = []
+        with monkeypatch.context() as patch:
+            patch.setattr(sync, 'sync_activity', lambda vle_id, activity_id, activity_type: synced.append(activity_id))
+            response = client_with_certificate_tip.get(resource_url, headers={'If-None-Match': etag})
+        assert (response.status_code == 304)
+        assert (synced == [])
+
+
 def test_activity_delete_activity(base_api_url, app, client_with_certificate_tip):
     """ Check entrypoint activities/delete """
 
@@ -252,3 +317,128 @@ def test_activity_get_activity_results(base_api_url, app, client_with_certificat
 
     assert (response.status_code == 200)
     assert (len(response_json['items']) == 0)
+
+
+def test_activity_get_activity_results_cursor(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint activities/activity/results with cursor pagination """
+    import uuid
+    from tesla_api import tesla_db
+    from .seed import insert_activity_results, delete_activity_results
+
+    vle_id = 1
+    activity_type = "test_cursor"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+    url = base_api_url+str("activities")+"/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)+"/results"
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+    with app.app_context():
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[1], 1, 3, None),
+                                              (tesla_ids[2], 2, 2, 0.75), (tesla_ids[2], 1, 0, None)])
+    try:
+        response = client_with_certificate_tip.get(url, content_type='application/json')
+        assert (response.status_code == 200)
+        page_items = sorted(response.get_json()['items'], key=lambda item: item['tesla_id'])
+        assert ([item['tesla_id'] for item in page_items] == tesla_ids)
+
+        response = client_with_certificate_tip.get(url+"?cursor=&per_page=2", content_type='application/json')
+        response_json = response.get_json()
+        assert (response.status_code == 200)
+        assert (len(response_json['items']) == 2)
+        assert (response_json['next_cursor'] is not None)
+        cursor_items = response_json['items']
+
+        response = client_with_certificate_tip.get(url+"?per_page=2&cursor="+response_json['next_cursor'], content_type='application/json')
+        response_json = response.get_json()
+        assert (response.status_code == 200)
+        assert (response_json['next_cursor'] is None)
+        cursor_items += response_json['items']
+
+        # Both paginations return the same items
+        assert (cursor_items == page_items)
+
+        response = client_with_certificate_tip.get(url+"?cursor=invalid", content_type='application/json')
+        assert (response.status_code == 400)
+    finally:
+        with app.app_context():
+            delete_activity_results(activity.id, tesla_ids)
+
+
+def test_activity_export_activity_results(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint activities/activity/results/export """
+    import uuid
+    from tesla_api import tesla_db
+    from .seed import insert_activity_results, delete_activity_results
+
+    vle_id = 1
+    activity_type = "test_export"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+    with app.app_context():
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[0], 1, 3, None),
+                                              (tesla_ids[1], 1, 0, None),
+                                              (tesla_ids[2], 1, 2, 0.25), (tesla_ids[2], 2, 2, 0.75),
+                                              (tesla_ids[2], 2, 1, None)])
+    try:
+        response = client_with_certificate_tip.get(base_api_url+str("activities")+"/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)+"/results/export")
+
+        assert (response.status_code == 200)
+        assert (response.mimetype == 'application/x-ndjson')
+        learner_results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert ([learner_result['tesla_id'] for learner_result in learner_results] == tesla_ids)
+        assert ([(learner_result['valid'], learner_result['failed'], learner_result['pending'])
+                 for learner_result in learner_results] == [(1, 1, 0), (0, 0, 1), (2, 0, 1)])
+        assert ([len(learner_result['instruments']) for learner_result in learner_results] == [1, 1, 2])
+    finally:
+        with app.app_context():
+            delete_activity_results(activity.id, tesla_ids)
+
+
+def test_activity_learners_summary_parity(app):
+    """ Check the grouped learners summary is equal to the summary of each learner computed by the repository """
+    import uuid
+    import tesla_models.schemas as schemas
+    from tesla_api import tesla_db, queries
+    from .seed import insert_row
+
+    with app.app_context():
+        try:
+            activity_id = insert_row('activity', vle_id=1, activity_type='summary_parity',
+                                     activity_id=str(uuid.uuid4()))
+            tesla_ids = [str(uuid.uuid4()) for _ in range(3)]
+            for tesla_id in tesla_ids:
+                insert_row('learner', tesla_id=tesla_id)
+
+            # One learner with results in every status, one with only pending results and one without results
+            statuses = [(1, 2, 0.25), (1, 2, 0.75), (1, 3, None), (1, 0, None), (1, 1, None), (2, 2, 1.0), (2, 3, None)]
+            for instrument_id, status, value in statuses:
+                request_id = insert_row('request', tesla_id=tesla_ids[0], activity_id=activity_id, is_enrolment=False)
+                insert_row('request_result', request_id=request_id, instrument_id=instrument_id, status=status,
+                           value=value)
+            request_id = insert_row('request', tesla_id=tesla_ids[1], activity_id=activity_id, is_enrolment=False)
+            insert_row('request_result', request_id=request_id, instrument_id=1, status=0)
+            # Enrolment results are not part of the activity summary
+            request_id = insert_row('request', tesla_id=tesla_ids[1], activity_id=activity_id, is_enrolment=True)
+            insert_row('request_result', request_id=request_id, instrument_id=1, status=2, value=0.5)
+
+            summaries = queries.get_activity_learners_summary(activity_id, tesla_ids)
+            exported = dict(queries.iter_activity_learners_summary(activity_id))
+
+            assert(sorted(summaries.keys()) == sorted(tesla_ids))
+            assert(sorted(exported.keys()) == sorted(tesla_ids[:2]))
+            for tesla_id in tesla_ids:
+                expected = tesla_db.activities.get_activity_learner_summary(activity_id, tesla_id)
+                for schema in (schemas.InstrumentResultsSummary, schemas.LearnerInstrumentResults):
+                    expected_json = schema(many=True).dump(expected).data
+                    assert(schema(many=True).dump(summaries[tesla_id]).data == expected_json)
+                    assert(schema(many=True).dump(exported.get(tesla_id, [])).data == expected_json)
+        finally:
+            tesla_db.db.session.rollback()
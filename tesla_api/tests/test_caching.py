@@ -0,0 +1,111 @@
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from tesla_api.caching import TTLCache
+
+
+def test_ttl_cache_hit_miss():
+    """ Check TTLCache hit and miss counters """
+
+    cache = TTLCache(maxsize=2, ttl=60)
+
+    assert(cache.get('a') is None)
+    cache.set('a', 1)
+    assert(cache.get('a') == 1)
+
+    stats = cache.stats()
+    assert(stats['hits'] == 1)
+    assert(stats['misses'] == 1)
+
+
+def test_ttl_cache_lru_eviction():
+    """ Check TTLCache discards the least recently used entry """
+
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert(cache.get('a') == 1)
+    assert(cache.get('b') is None)
+    assert(cache.get('c') == 3)
+
+
+def test_ttl_cache_expiration():
+    """ Check TTLCache entries expire """
+
+    cache = TTLCache(maxsize=2, ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+
+    assert(cache.get('a') is None)
+    assert(len(cache) == 0)
+
+
+def test_ttl_cache_invalidation():
+    """ Check TTLCache explicit invalidation """
+
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('a', {'acronym': 'KS'})
+    cache.set('b', {'acronym': 'TEP'})
+    cache.set('c', {'acronym': 'KS'})
+
+    assert(cache.invalidate_if(lambda module: module['acronym'] == 'KS') == 2)
+    assert(cache.get('b') is not None)
+
+    cache.invalidate('b')
+    assert(cache.get('b') is None)
+
+
+def test_single_flight_coalescing():
+    """ Check SingleFlight executes concurrent calls for the same key once """
+    import threading
+    from tesla_api.caching import SingleFlight
+
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    executions = []
+    results = []
+
+    def slow_sync(value):
+        executions.append(value)
+        started.set()
+        release.wait(5)
+        return value
+
+    def caller():
+        results.append(flight.do('activity', slow_sync, 1))
+
+    leader = threading.Thread(target=caller)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=caller) for i in range(5)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()['coalesced'] < 5:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert(executions == [1])
+    assert(results == [1] * 6)
+    assert(flight.stats() == {'calls': 1, 'coalesced': 5, 'in_flight': 0})
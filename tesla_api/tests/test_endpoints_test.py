@@ -103,3 +103,30 @@ def test_test_tep_inject(base_api_url, app, client_with_certificate_tep):
 
     response_json = response.get_json()
     assert(int(response_json['status_code']) == 0)
+
+
+def test_test_cert_module_cache(base_api_url, app, client_with_certificate_ks):
+    """ Check resolved certificate modules are cached """
+    from tesla_api.utils import cert_module_cache
+
+    client_with_certificate_ks.get(base_api_url+str("test/any_module"))
+    hits = cert_module_cache.stats()['hits']
+    response = client_with_certificate_ks.get(base_api_url+str("test/any_module_inject"))
+
+    response_json = response.get_json()
+    assert(int(response_json['status_code']) == 0)
+    assert(cert_module_cache.stats()['hits'] == hits + 1)
+
+
+def test_test_tep_proxy_headers(base_api_url, app, client, monkeypatch):
+    """ Check entrypoint test/tep with the certificate identity verified by nginx """
+
+    monkeypatch.setenv('TRUST_PROXY_CERT_HEADERS', '1')
+    client.environ_base = {"HTTP_X_SSL_CLIENT_VERIFY": "SUCCESS",
+                           "HTTP_X_SSL_CLIENT_S_DN": "CN=tep,O=TeSLA",
+                           "HTTP_X_SSL_CLIENT_FINGERPRINT": "00112233445566778899aabbccddeeff00112233"}
+
+    response = client.get(base_api_url+str("test/tep"))
+
+    response_json = response.get_json()
+    assert(int(response_json['status_code']) == 0)
@@ -0,0 +1,69 @@
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from tesla_api import catalog
+
+
+def test_instruments_get_instruments(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint instruments/get_instruments """
+
+    response = client_with_certificate_tip.get(base_api_url+str("instruments"))
+    response_json = response.get_json()
+
+    assert(response.status_code == 200)
+    assert(int(response_json['status_code']) == 0)
+    assert([inst['acronym'] for inst in response_json['items'] if inst['id'] == 5] == ['KS'])
+
+
+def test_instruments_get_instrument_thresholds(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint instruments/thresholds """
+
+    response = client_with_certificate_tip.get(base_api_url+str("instruments/1/thresholds"))
+    response_json = response.get_json()
+
+    assert(response.status_code == 200)
+    assert(int(response_json['status_code']) == 0)
+    assert(response_json['audit_level'] == 'medium')
+
+    response = client_with_certificate_tip.get(base_api_url+str("instruments/999/thresholds"))
+
+    assert(response.status_code == 404)
+
+
+def test_instruments_catalog(app):
+    """ Check the instrument catalog is only reloaded when the version changes """
+
+    with app.app_context():
+        instrument_catalog = catalog.get_catalog()
+        catalog.invalidate()
+
+        assert(catalog.get_catalog() is instrument_catalog)
+        assert(catalog.get_instrument_by_acronym('ks')['id'] == 5)
+        assert(catalog.get_instrument_by_id(999) is None)
+
+
+def test_instruments_conditional_get(base_api_url, app, client_with_certificate_tip):
+    """ Check instruments and thresholds are not sent again when the ETag matches """
+
+    for url in ["instruments", "instruments/1/thresholds"]:
+        response = client_with_certificate_tip.get(base_api_url+str(url))
+        assert(response.status_code == 200)
+        etag = response.headers['ETag']
+
+        response = client_with_certificate_tip.get(base_api_url+str(url), headers={'If-None-Match': etag})
+        assert(response.status_code == 304)
+        assert(response.headers['ETag'] == etag)
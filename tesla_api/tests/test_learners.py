@@ -111,6 +111,68 @@ def test_learner_get_learner_instrument_enrolment(base_api_url, app, client_with
     # todo make test with add learner when it will be possible
 
 
+def test_learner_instrument_enrolment_status_parity(app, monkeypatch):
+    """ Check the enrolment status query is equal to the status computed by the repository """
+    from sqlalchemy import text
+    from tesla_api import tesla_db, queries
+
+    monkeypatch.setattr(queries, 'ENROLMENT_COUNTERS', False)
+
+    with app.app_context():
+        pairs = [(str(row.tesla_id), row.instrument_id) for row in tesla_db.db.session.execute(text(
+            "SELECT DISTINCT r.tesla_id, rr.instrument_id FROM request r "
+            "JOIN request_result rr ON rr.request_id = r.id WHERE r.is_enrolment LIMIT 50")).fetchall()]
+        pairs += [("9cd125c3-badb-4aa7-b694-321e0d76858f", instrument_id) for instrument_id in range(1, 9)]
+
+        for tesla_id, instrument_id in pairs:
+            status = queries.get_learner_instrument_enrolment_status(tesla_id, instrument_id)
+
+            learner_enrolment = tesla_db.learners.get_learner_enrolment(tesla_id, instrument_id)
+            if learner_enrolment is None:
+                assert(status['percentage'] is None)
+            else:
+                assert(status['percentage'] == learner_enrolment.percentage)
+            assert(status['completed'] ==
+                   tesla_db.learners.count_learner_completed_requests(tesla_id, True, instrument_id))
+            assert(status['pending'] == tesla_db.learners.count_learner_pending_requests(tesla_id, True, instrument_id))
+
+
+def test_learner_enrolment_counters_request_delete(app):
+    """ Check the enrolment counters subtract the results of a deleted enrolment request """
+    import uuid
+    from sqlalchemy import text
+    from tesla_api import tesla_db, counters
+    from .seed import insert_row
+
+    tesla_id = str(uuid.uuid4())
+    params = {'tesla_id': tesla_id}
+    count_query = text("SELECT completed, pending FROM learner_enrolment_counter "
+                       "WHERE tesla_id = :tesla_id AND instrument_id = 1")
+
+    with app.app_context():
+        counters.install_enrolment_counters()
+        insert_row('learner', tesla_id=tesla_id)
+        request_id = insert_row('request', tesla_id=tesla_id, is_enrolment=True)
+        insert_row('request_result', request_id=request_id, instrument_id=1, status=2, value=1.0)
+        insert_row('request_result', request_id=request_id, instrument_id=1, status=0, value=None)
+        tesla_db.db.session.commit()
+        try:
+            assert(tuple(tesla_db.db.session.execute(count_query, params).fetchone()) == (1, 1))
+
+            # Results are removed by the cascade after the request, and the counters must not keep them
+            tesla_db.db.session.execute(text("DELETE FROM request WHERE id = :request_id"), {'request_id': request_id})
+            tesla_db.db.session.commit()
+            assert(tuple(tesla_db.db.session.execute(count_query, params).fetchone()) == (0, 0))
+        finally:
+            tesla_db.db.session.execute(text("DELETE FROM request_result WHERE request_id IN "
+                                             "(SELECT id FROM request WHERE tesla_id = :tesla_id)"), params)
+            tesla_db.db.session.execute(text("DELETE FROM request WHERE tesla_id = :tesla_id"), params)
+            tesla_db.db.session.execute(text("DELETE FROM learner_enrolment_counter WHERE tesla_id = :tesla_id"),
+                                        params)
+            tesla_db.db.session.execute(text("DELETE FROM learner WHERE tesla_id = :tesla_id"), params)
+            tesla_db.db.session.commit()
+
+
 def test_learner_get_learner_activity_enrolments(base_api_url, app, client_with_certificate_tip):
     """ Check entrypoint learners/activities/enrolment """
 
@@ -203,3 +265,185 @@ def test_learner_get_learner_activity_request_instrument_audit(base_api_url, app
     response = client_with_certificate_tip.get(base_api_url+str("learners")+"/"+str(tesla_id)+"/activities/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)+"/requests/"+str(request_id)+"/instruments/"+str(instrument_id)+"/audit")
 
     assert(response.status_code == 501)
+
+
+def test_learner_request_memoization(app):
+    """ Check memoized functions are executed once per request """
+    from flask import make_response
+    from tesla_api import sync
+
+    calls = []
+
+    @sync.request_memoize
+    def get_value(tesla_id):
+        calls.append(tesla_id)
+        return tesla_id
+
+    with app.test_request_context():
+        assert(get_value("9cd125c3-badb-4aa7-b694-321e0d76858f") == "9cd125c3-badb-4aa7-b694-321e0d76858f")
+        assert(get_value("9cd125c3-badb-4aa7-b694-321e0d76858f") == "9cd125c3-badb-4aa7-b694-321e0d76858f")
+        assert(len(calls) == 1)
+        assert(sync.get_avoided_calls() == {'get_value': 1})
+
+        debug_avoided_calls = sync.DEBUG_AVOIDED_CALLS
+        try:
+            sync.DEBUG_AVOIDED_CALLS = False
+            assert('X-TeSLA-Avoided-Calls' not in sync.log_avoided_calls(make_response('')).headers)
+            sync.DEBUG_AVOIDED_CALLS = True
+            assert(sync.log_avoided_calls(make_response('')).headers['X-TeSLA-Avoided-Calls'] == '1')
+        finally:
+            sync.DEBUG_AVOIDED_CALLS = debug_avoided_calls
+
+
+def test_learner_negative_cache(base_api_url, app, client_with_certificate_tip):
+    """ Check unknown learners are not synchronized again while they are in the negative cache """
+    from tesla_api import sync
+
+    tesla_id = "00000000-0000-0000-0000-000000000000"
+
+    response = client_with_certificate_tip.get(base_api_url+str("learners")+"/"+str(tesla_id)+"/send")
+    assert(response.status_code == 200)
+    hits = sync.get_stats()['negative']['hits']
+
+    response = client_with_certificate_tip.get(base_api_url+str("learners")+"/"+str(tesla_id)+"/send")
+    assert(response.status_code == 200)
+    assert(sync.get_stats()['negative']['hits'] == hits + 1)
+
+    sync.invalidate_learner(tesla_id)
+
+
+def test_learners_activity_instruments(base_api_url, app, client, client_with_certificate_tip, monkeypatch):
+    """ Check entrypoint learners/activities/instruments for a list of learners """
+    from types import SimpleNamespace
+    from tesla_api import sync, utils
+    from tesla_api.api import learners as learners_api
+
+    tesla_id = "9cd125c3-badb-4aa7-b694-321e0d76858f"
+    unknown_tesla_id = "00000000-0000-0000-0000-000000000001"
+    vle_id = "1"
+    activity_type = "quiz"
+    activity_id = "1"
+    url = base_api_url+str("learners")+"/activities/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)+"/instruments"
+    data = json.dumps({'tesla_ids': [tesla_id, unknown_tesla_id]})
+
+    response = client.post(url, data=data, content_type='application/json')
+    assert(response.status_code == 401)
+
+    send_profile = utils.SendProfile(version='test', is_send=True, disabled_instruments=frozenset([2]),
+                                     options=frozenset())
+    monkeypatch.setattr(sync, 'sync_activity', lambda vle_id, activity_id, activity_type: None)
+    monkeypatch.setattr(sync, 'get_activity_by_def', lambda vle_id, activity_type, activity_id: SimpleNamespace(id=1))
+    monkeypatch.setattr(sync, 'sync_learners', lambda tesla_ids, is_current=None: {tesla_id: SimpleNamespace(tesla_id=tesla_id)})
+    monkeypatch.setattr(learners_api, 'get_activity_instrument_config', lambda activity_id: utils.ActivityInstrumentConfig(
+        'test', (utils.ActivityInstrument(1, True, None), utils.ActivityInstrument(2, False, 3))))
+    monkeypatch.setattr(learners_api, 'get_ic_info', lambda learner: {
+        'learner_found': learner is not None, 'ic_valid': learner is not None, 'ic_current_version': '1.0.0',
+        'rejected_date': None})
+    monkeypatch.setattr(learners_api, 'get_learner_send_profiles',
+                        lambda tesla_ids: dict((str(learner_id), send_profile) for learner_id in tesla_ids))
+
+    response = client_with_certificate_tip.post(url, data=data, content_type='application/json')
+    assert(response.status_code == 200)
+    response_json = response.get_json()
+    assert(int(response_json['status_code']) == 0)
+
+    learner, unknown_learner = response_json['learners']
+    assert(learner['tesla_id'] == tesla_id)
+    assert(learner['agreement_status'] is True)
+    assert(learner['instrument_ids'] == [1, 3])
+    assert(learner['send'] == send_profile.to_json())
+    assert(unknown_learner['tesla_id'] == unknown_tesla_id)
+    assert(unknown_learner['learner_found'] is False)
+    assert(unknown_learner['instrument_ids'] == [])
+
+    data = json.dumps({'tesla_ids': ['not-a-uuid']})
+    response = client_with_certificate_tip.post(url, data=data, content_type='application/json')
+    assert(response.status_code == 400)
+
+
+def test_learners_sync_current_consent(app, monkeypatch):
+    """ Check only the learners missing in the database or without a current consent are synchronized with the TEP """
+    from types import SimpleNamespace
+    from tesla_api import sync, queries
+
+    consented = "3b1f2a4c-5d6e-4f70-8a9b-0c1d2e3f4a5b"
+    not_consented = "4c2a3b5d-6e7f-4a81-9bac-1d2e3f4a5b6c"
+    missing = "5d3b4c6e-7f8a-4b92-acbd-2e3f4a5b6c7d"
+    rows = {consented: SimpleNamespace(tesla_id=consented, consent_id=1),
+            not_consented: SimpleNamespace(tesla_id=not_consented, consent_id=None)}
+
+    synced = []
+    monkeypatch.setattr(sync, 'SYNC_MODE', 'inline')
+    monkeypatch.setattr(sync, 'tep_db', SimpleNamespace(sync_learner=lambda tesla_id: synced.append(tesla_id) or True))
+    monkeypatch.setattr(queries, 'get_learners', lambda tesla_ids: [rows[t] for t in tesla_ids if t in rows])
+
+    with app.app_context():
+        learners = sync.sync_learners([consented, not_consented, missing],
+                                      is_current=lambda learner: learner.consent_id is not None)
+
+    assert(sorted(synced) == sorted([not_consented, missing]))
+    assert(sorted(learners.keys()) == sorted([consented, not_consented]))
+
+
+def test_learners_enrolment(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint learners/enrolment for a list of learners and instruments """
+
+    tesla_id = "9cd125c3-badb-4aa7-b694-321e0d76858f"
+    instrument_id = 1
+
+    data = json.dumps({'tesla_ids': [tesla_id], 'instrument_ids': [instrument_id]})
+    response = client_with_certificate_tip.post(base_api_url+str("learners")+"/enrolment", data=data, content_type='application/json')
+    assert(response.status_code == 200)
+    response_json = json.loads(response.get_data(as_text=True))
+    assert(int(response_json['status_code']) == 0)
+
+    single = client_with_certificate_tip.get(base_api_url+str("learners")+"/"+str(tesla_id)+"/instruments/"+str(instrument_id)+"/enrolment").get_json()
+    enrolment = response_json['learners'][0]['instruments'][str(instrument_id)]
+    assert(enrolment['enrolment_phase_id'] == single['enrolment_phase_id'])
+    assert(enrolment['enrolment_completion'] == single['enrolment_completion'])
+
+    # Without a list of instruments, the instruments with requires_enrollment set are used
+    data = json.dumps({'tesla_ids': [tesla_id]})
+    response = client_with_certificate_tip.post(base_api_url+str("learners")+"/enrolment", data=data, content_type='application/json')
+    assert(response.status_code == 200)
+    response_json = json.loads(response.get_data(as_text=True))
+    assert(sorted(response_json['learners'][0]['instruments'].keys()) == ['1', '3', '5', '7'])
+
+
+def test_learner_mirror_consent(app, monkeypatch):
+    """ Check mirrored learners are served from the database in mirror mode, and the worker refreshes their consent """
+    from types import SimpleNamespace
+    from tesla_api import sync, sync_worker, tesla_db
+    from .seed import insert_row
+
+    synced = []
+    tep = SimpleNamespace(sync_learner=lambda tesla_id: synced.append(tesla_id),
+                          sync_activity=lambda vle_id, activity_id, activity_type: None)
+    monkeypatch.setattr(sync, 'SYNC_MODE', 'mirror')
+    monkeypatch.setattr(sync, 'tep_db', tep)
+    monkeypatch.setattr(sync_worker, 'tep_db', tep)
+    monkeypatch.setattr(sync_worker, 'SYNC_REFRESH_SIZE', 100000)
+
+    tesla_id = "5d0f3c4e-2f53-4c55-a3f5-4b1b9a0b7c21"
+    unknown_tesla_id = "0b6e3f8d-1c2a-4e5b-9f7d-8a6c5b4d3e21"
+    with app.app_context():
+        insert_row('learner', tesla_id=tesla_id)
+        tesla_db.db.session.commit()
+        try:
+            # Mirrored learners are not synchronized on the request path
+            assert(sync.sync_learner(tesla_id) is not None)
+            assert(list(sync.sync_learners([tesla_id]).keys()) == [tesla_id])
+            assert(synced == [])
+
+            # Learners not found in the database are synchronized inline
+            assert(sync.sync_learner(unknown_tesla_id) is None)
+            assert(synced == [unknown_tesla_id])
+
+            # The worker refreshes all the known learners
+            del synced[:]
+            sync_worker.refresh_cycle()
+            assert(tesla_id in synced)
+        finally:
+            tesla_db.db.session.execute("DELETE FROM learner WHERE tesla_id = :tesla_id", {'tesla_id': tesla_id})
+            tesla_db.db.session.commit()
+            sync.invalidate_learner(unknown_tesla_id)
@@ -0,0 +1,290 @@
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import uuid
+
+from tesla_api import utils, tesla_db
+from .seed import insert_activity_results, delete_activity_results
+
+
+def test_reports_activity_report_filters(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint reports/activity with invalid filters """
+
+    vle_id = 1
+    activity_type = "quiz"
+    activity_id = "1"
+    url = base_api_url+str("reports")+"/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)
+
+    response = client_with_certificate_tip.get(url+"?instruments=1,a", content_type='application/json')
+    assert (response.status_code == 400)
+
+    response = client_with_certificate_tip.get(url+"?max_auth_level=low", content_type='application/json')
+    assert (response.status_code == 400)
+
+    response = client_with_certificate_tip.get(url+"?order=best", content_type='application/json')
+    assert (response.status_code == 400)
+
+
+def test_reports_level_cursor():
+    """ Check the cursor of learners sorted by level """
+
+    tesla_id = "8f1d4e7a-4c1b-4f0e-9a53-0e0c2a2f6b11"
+    cursor = utils.encode_cursor(tesla_id, level=2)
+
+    assert (utils.decode_level_cursor(cursor) == (2, tesla_id))
+    assert (utils.decode_cursor(cursor) == tesla_id)
+    assert (utils.decode_level_cursor("") is None)
+    try:
+        utils.decode_level_cursor(utils.encode_cursor(tesla_id))
+        assert (False)
+    except ValueError:
+        pass
+
+
+def test_reports_activity_report_cursor(base_api_url, app, client_with_certificate_tip):
+    """ Check entrypoint reports/activity returns the same learners with page and cursor pagination """
+
+    vle_id = 1
+    activity_type = "test_report_cursor"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+    url = base_api_url+str("reports")+"/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(2))
+    with app.app_context():
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[1], 1, 2, 0.9)])
+    try:
+        response = client_with_certificate_tip.get(url, content_type='application/json')
+        assert (response.status_code == 200)
+        page_items = sorted(response.get_json()['results']['items'], key=lambda item: item['tesla_id'])
+
+        response = client_with_certificate_tip.get(url+"?cursor=", content_type='application/json')
+        assert (response.status_code == 200)
+        cursor_items = response.get_json()['results']['items']
+
+        assert ([item['tesla_id'] for item in cursor_items] == tesla_ids)
+        assert (cursor_items == page_items)
+    finally:
+        with app.app_context():
+            delete_activity_results(activity.id, tesla_ids)
+
+
+def test_reports_results_version(base_api_url, app, client_with_certificate_tip):
+    """ Check the version of the activity results changes when a result is written in the database """
+    from sqlalchemy import text
+
+    vle_id = 1
+    activity_type = "test_results_version"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+
+    tesla_ids = [str(uuid.uuid4())]
+    with app.app_context():
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        empty_version = utils.get_activity_results_version(activity.id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 0, None)])
+        try:
+            version = utils.get_activity_results_version(activity.id)
+            assert (version != empty_version)
+            assert (utils.get_activity_results_version(activity.id) == version)
+            context = utils.get_activity_context(activity.id, version)
+
+            tesla_db.db.session.execute(text(
+                "UPDATE request_result SET status = 2, value = 0.5 WHERE request_id IN "
+                "(SELECT id FROM request WHERE activity_id = :activity_id)"), {'activity_id': activity.id})
+            tesla_db.db.session.commit()
+
+            new_version = utils.get_activity_results_version(activity.id)
+            assert (new_version != version)
+            assert (sum(utils.get_activity_context(activity.id, new_version)['histograms'][1]) ==
+                    sum(context['histograms'].get(1, [])) + 1)
+        finally:
+            delete_activity_results(activity.id, tesla_ids)
+
+
+def test_reports_activity_levels_version(base_api_url, app, client_with_certificate_tip, monkeypatch):
+    """ Check the stored levels are only computed again for the learners whose results change in the database """
+    from sqlalchemy import text
+    from tesla_api import activity_reports
+
+    monkeypatch.setattr(activity_reports, 'ACTIVITY_REPORTS', True)
+
+    vle_id = 1
+    activity_type = "test_levels_version"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(2))
+    with app.app_context():
+        activity_reports.install_activity_reports()
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[1], 1, 2, 0.9)])
+        try:
+            version = utils.get_activity_results_version(activity.id)
+            assert (version.startswith('report_'))
+
+            def refresh(version):
+                context = utils.get_activity_context(activity.id, version)
+                context_statistics = dict((instrument_id, {'histogram': histogram, 'thresholds': None})
+                                          for instrument_id, histogram in context['histograms'].items())
+                return activity_reports.refresh_activity_levels(activity.id, context_statistics, version)
+
+            assert (refresh(version) == 2)
+            # Storing the levels does not change the version, so they are not computed again
+            assert (utils.get_activity_results_version(activity.id) == version)
+            assert (refresh(version) == 0)
+
+            tesla_db.db.session.execute(text(
+                "UPDATE request_result SET value = 0.1 WHERE request_id IN "
+                "(SELECT id FROM request WHERE activity_id = :activity_id AND tesla_id = :tesla_id)"),
+                {'activity_id': activity.id, 'tesla_id': tesla_ids[0]})
+            tesla_db.db.session.commit()
+
+            new_version = utils.get_activity_results_version(activity.id)
+            assert (new_version != version)
+            assert (refresh(new_version) == 1)
+            assert (refresh(new_version) == 0)
+        finally:
+            delete_activity_results(activity.id, tesla_ids)
+            tesla_db.db.session.execute(text("DELETE FROM activity_learner_levels WHERE activity_id = :activity_id"),
+                                        {'activity_id': activity.id})
+            tesla_db.db.session.commit()
+
+
+def test_reports_activity_report_request_delete(base_api_url, app, client_with_certificate_tip):
+    """ Check the report rows of a learner are removed when its request is deleted with its results """
+    from sqlalchemy import text
+    from tesla_api import activity_reports
+
+    vle_id = 1
+    activity_type = "test_request_delete"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(2))
+    with app.app_context():
+        activity_reports.install_activity_reports()
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[1], 1, 2, 0.9)])
+        try:
+            version = activity_reports.get_activity_results_version(activity.id)
+            assert (len(activity_reports.get_activity_learners_summary(activity.id, tesla_ids)[tesla_ids[0]]) == 1)
+
+            # Only the request is deleted, its results are removed by the cascade
+            tesla_db.db.session.execute(text(
+                "DELETE FROM request WHERE activity_id = :activity_id AND tesla_id = :tesla_id"),
+                {'activity_id': activity.id, 'tesla_id': tesla_ids[0]})
+            tesla_db.db.session.commit()
+
+            summaries = activity_reports.get_activity_learners_summary(activity.id, tesla_ids)
+            assert (summaries[tesla_ids[0]] == [])
+            assert (len(summaries[tesla_ids[1]]) == 1)
+            assert (activity_reports.get_activity_results_version(activity.id) != version)
+        finally:
+            delete_activity_results(activity.id, tesla_ids)
+
+
+def test_reports_activity_report_stored_levels(base_api_url, app, client_with_certificate_tip, monkeypatch):
+    """ Check entrypoint reports/activity sorted by level returns the stored levels used to sort the learners """
+    from sqlalchemy import text
+    from tesla_api import activity_reports
+
+    monkeypatch.setattr(activity_reports, 'ACTIVITY_REPORTS', True)
+
+    vle_id = 1
+    activity_type = "test_stored_levels"
+    activity_id = str(uuid.uuid4())
+    data = json.dumps({"vle_id": vle_id, "activity_type": activity_type, "activity_id": activity_id, "description": "test description", "conf": ""})
+    response = client_with_certificate_tip.post(base_api_url+str("activities"), data=data, content_type='application/json')
+    assert (response.status_code == 200)
+    url = base_api_url+str("reports")+"/"+str(vle_id)+"/"+str(activity_type)+"/"+str(activity_id)
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+    with app.app_context():
+        activity_reports.install_activity_reports()
+        activity = tesla_db.activities.get_activity_by_def(vle_id, activity_type, activity_id)
+        insert_activity_results(activity.id, [(tesla_ids[0], 1, 2, 0.1), (tesla_ids[1], 1, 2, 0.9),
+                                              (tesla_ids[2], 1, 2, 0.5), (tesla_ids[2], 2, 2, 0.5)])
+    try:
+        response = client_with_certificate_tip.get(url+"?order=worst&cursor=", content_type='application/json')
+        assert (response.status_code == 200)
+        items = response.get_json()['results']['items']
+        assert (sorted(item['tesla_id'] for item in items) == tesla_ids)
+
+        with app.app_context():
+            stored_levels = activity_reports.get_activity_learners_levels(activity.id, tesla_ids)
+        assert ([item['levels'] for item in items] == [stored_levels[item['tesla_id']] for item in items])
+        assert ([(item['levels']['worst_level'], item['tesla_id']) for item in items] ==
+                sorted((item['levels']['worst_level'], item['tesla_id']) for item in items))
+
+        # The instruments subset narrows the learners, but they keep the levels of all the instruments
+        response = client_with_certificate_tip.get(url+"?order=worst&cursor=&instruments=2", content_type='application/json')
+        assert (response.status_code == 200)
+        items = response.get_json()['results']['items']
+        assert ([item['tesla_id'] for item in items] == [tesla_ids[2]])
+        assert (items[0]['levels'] == stored_levels[tesla_ids[2]])
+    finally:
+        with app.app_context():
+            delete_activity_results(activity.id, tesla_ids)
+            tesla_db.db.session.execute(text("DELETE FROM activity_learner_levels WHERE activity_id = :activity_id"),
+                                        {'activity_id': activity.id})
+            tesla_db.db.session.commit()
+
+
+def test_reports_learners_histograms_parity(app):
+    """ Check the grouped learners histograms are equal to the histogram of each learner computed by the repository """
+    from sqlalchemy import text, bindparam
+    from tesla_api import queries
+    from .seed import insert_row
+
+    tesla_ids = sorted(str(uuid.uuid4()) for _ in range(2))
+    with app.app_context():
+        activity_ids = [insert_row('activity', vle_id=1, activity_type='histograms_parity',
+                                   activity_id=str(uuid.uuid4())) for _ in range(2)]
+        tesla_db.db.session.commit()
+        # Values on the limits and on a bin edge, failed and pending results and results in two activities
+        insert_activity_results(activity_ids[0], [(tesla_ids[0], 1, 2, 0.0), (tesla_ids[0], 1, 2, 1.0),
+                                                  (tesla_ids[0], 1, 2, 0.5), (tesla_ids[0], 1, 2, 0.25),
+                                                  (tesla_ids[0], 1, 3, 0.4), (tesla_ids[0], 1, 0, None),
+                                                  (tesla_ids[0], 2, 2, 0.99), (tesla_ids[1], 1, 2, 0.75)])
+        insert_activity_results(activity_ids[1], [(tesla_ids[0], 1, 2, 0.5), (tesla_ids[1], 1, 2, 1.0)])
+        try:
+            histograms = queries.get_learners_valid_results_histograms(tesla_ids, [1, 2])
+            assert (histograms[(tesla_ids[0], 1)] == [1, 0, 1, 0, 0, 2, 0, 0, 0, 1])
+            for tesla_id, instrument_id in [(tesla_ids[0], 1), (tesla_ids[0], 2), (tesla_ids[1], 1)]:
+                expected = tesla_db.statistics.get_learner_instrument_valid_results_histogram(tesla_id, instrument_id)
+                assert (histograms[(tesla_id, instrument_id)] == [int(total) for total in expected])
+        finally:
+            params = {'activity_ids': activity_ids}
+            for statement in ["DELETE FROM request_result WHERE request_id IN "
+                              "(SELECT id FROM request WHERE activity_id IN :activity_ids)",
+                              "DELETE FROM request WHERE activity_id IN :activity_ids",
+                              "DELETE FROM activity WHERE id IN :activity_ids"]:
+                tesla_db.db.session.execute(text(statement).bindparams(bindparam('activity_ids', expanding=True)),
+                                            params)
+            tesla_db.db.session.commit()
+            delete_activity_results(activity_ids[0], tesla_ids)
@@ -0,0 +1,87 @@
+#  TeSLA API
+#  Copyright (C) 2019 Universitat Oberta de Catalunya
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import uuid
+
+from tesla_api import risk
+from tesla_api.api.reports import _get_learner_instrument_stats
+
+
+def _get_random_report(seed, num_learners, instrument_ids):
+    rnd = random.Random(seed)
+
+    context_statistics = {}
+    for instrument_id in instrument_ids:
+        thresholds = None
+        if rnd.random() < 0.5:
+            thresholds = {'low': 0.2, 'medium': rnd.choice([0.3, 0.5, 0.7]), 'high': 0.9}
+        context_statistics[instrument_id] = {
+            'histogram': [rnd.randint(0, 50) for _ in range(10)],
+            'thresholds': thresholds
+        }
+
+    learner_results = []
+    histograms = {}
+    for _ in range(num_learners):
+        tesla_id = uuid.UUID(int=rnd.getrandbits(128))
+        instruments = {}
+        for instrument_id in instrument_ids:
+            if rnd.random() < 0.2:
+                continue
+            # Include the bin edges, where the scalar code takes a different branch
+            values = [rnd.choice([0.0, 0.05, 0.1, 0.95, 0.99, 1.0, rnd.random()]) for _ in range(3)]
+            instruments[instrument_id] = {
+                'instrument_id': instrument_id,
+                'valid': rnd.randint(0, 10),
+                'failed': rnd.randint(0, 10),
+                'average': sum(values) / len(values),
+                'min': min(values),
+                'max': max(values)
+            }
+            histograms[(str(tesla_id), instrument_id)] = [rnd.choice([0, 0, rnd.randint(0, 20)]) for _ in range(10)]
+        learner_results.append({'tesla_id': tesla_id, 'instruments': instruments})
+
+    return learner_results, context_statistics, histograms
+
+
+def test_risk_parity():
+    """ Check the vectorised risk levels are equal to the ones computed for each learner """
+
+    instrument_ids = [1, 2, 3, 4, 5, 6, 7]
+    for seed in range(20):
+        learner_results, context_statistics, histograms = _get_random_report(seed, 50, instrument_ids)
+
+        learners_stats = risk.get_learners_instrument_stats(learner_results, context_statistics, histograms)
+
+        assert(len(learners_stats) == len(learner_results))
+        for learner_result, learner_stats in zip(learner_results, learners_stats):
+            expected = _get_learner_instrument_stats(learner_result, context_statistics, histograms)
+            assert(learner_stats == expected)
+            for instrument_id in instrument_ids:
+                for key, value in expected['instruments'][instrument_id].items():
+                    assert(type(learner_stats['instruments'][instrument_id][key]) is type(value))
+
+
+def test_risk_empty():
+    """ Check the vectorised risk levels of a page without learners or instruments """
+
+    learner_results, context_statistics, histograms = _get_random_report(0, 3, [])
+
+    assert(risk.get_learners_instrument_stats([], {}, {}) == [])
+    for learner_stats in risk.get_learners_instrument_stats(learner_results, context_statistics, histograms):
+        assert(learner_stats == {'instruments': {}, 'levels': {'auth': 0, 'content': 0, 'security': 0}})
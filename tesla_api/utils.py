@@ -14,14 +14,54 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from tesla_api import tesla_db, cache, logger
-from tesla_models import tep_db
+from flask import request, make_response
+from tesla_api import tesla_db, cache, logger, catalog, sync, queries, activity_reports
+from tesla_api.caching import TTLCache, SingleFlight
 from distutils.version import LooseVersion
 from tesla_models.database.utils import decode_data
-from tesla_models.models import instrument_schema
+from tesla_models.constants import TESLA_ENROLLMENT_PHASE
+import tesla_models.schemas as schemas
 import jwt
+import os
+import json
+import uuid
+import base64
+import binascii
+import hashlib
+from collections import namedtuple
 from OpenSSL import crypto
 
+# Resolved certificate modules, indexed by a digest of the certificate sent by nginx
+cert_module_cache = TTLCache(maxsize=int(os.getenv('CERT_MODULE_CACHE_SIZE', 256)),
+                             ttl=int(os.getenv('CERT_MODULE_CACHE_TTL', 300)))
+cert_module_flight = SingleFlight()
+
+# Current informed consent, checked again when the cached entry expires
+informed_consent_cache = TTLCache(maxsize=1, ttl=int(os.getenv('INFORMED_CONSENT_CACHE_TTL', 60)))
+_consent_table = None
+
+
+# Time to live of the cached context statistics of activity reports. They are cached for a version of the results
+# read from the database, so the time to live only limits the memory used by old versions.
+REPORT_CONTEXT_CACHE_TTL = int(os.getenv('REPORT_CONTEXT_CACHE_TTL', 300))
+
+# Maximum page size allowed in paginated requests
+MAX_PER_PAGE = int(os.getenv('MAX_PER_PAGE', 100))
+
+# SEND profiles, indexed by learner
+send_profile_cache = TTLCache(maxsize=int(os.getenv('SEND_PROFILE_CACHE_SIZE', 4096)),
+                              ttl=int(os.getenv('SEND_PROFILE_CACHE_TTL', 60)))
+
+# Instruments activated for each activity, and instruments resolved for each (configuration, disabled instruments)
+activity_instruments_cache = TTLCache(maxsize=int(os.getenv('ACTIVITY_INSTRUMENTS_CACHE_SIZE', 1024)),
+                                      ttl=int(os.getenv('ACTIVITY_INSTRUMENTS_CACHE_TTL', 60)))
+instrument_resolution_cache = TTLCache(maxsize=int(os.getenv('INSTRUMENT_RESOLUTION_CACHE_SIZE', 4096)),
+                                       ttl=int(os.getenv('INSTRUMENT_RESOLUTION_CACHE_TTL', 3600)))
+
+# Activities with some active instrument
+activity_tesla_active_cache = TTLCache(maxsize=int(os.getenv('ACTIVITY_TESLA_ACTIVE_CACHE_SIZE', 4096)),
+                                       ttl=int(os.getenv('ACTIVITY_TESLA_ACTIVE_CACHE_TTL', 60)))
+
 
 #@cache.memoize(900)
 def token_data(token):
@@ -33,7 +73,7 @@ def token_data(token):
     tesla_id = token_data['sub']
 
     # TODO: Remove if TEP is not deployed
-    learner = tep_db.sync_learner(tesla_id)
+    learner = sync.sync_learner(tesla_id)
     #learner = database.get_learner(tesla_id)
 
     # Get key
@@ -49,6 +89,19 @@ def token_data(token):
 #@cache.memoize(900)
 def get_learner_ic_info(tesla_id):
 
+    # Get the learner information
+    # TODO: Remove if TEP is not deployed
+    learner = sync.sync_learner(tesla_id)
+
+    return get_ic_info(learner)
+
+
+def get_ic_info(learner):
+    """
+    Get the informed consent information of a learner
+
+    :param learner: learner object, or None if the learner does not exist
+    """
     response = {'learner_found': False,
                 'ic_version': None,
                 'ic_current_version': None,
@@ -57,9 +110,6 @@ def get_learner_ic_info(tesla_id):
                 'ic_valid': False
                 }
 
-    # Get the learner information
-    # TODO: Remove if TEP is not deployed
-    learner = tep_db.sync_learner(tesla_id)
     if learner is None:
         return response
 
@@ -69,70 +119,363 @@ def get_learner_ic_info(tesla_id):
     if learner.consent_id is None:
         return response
 
-    ic = tesla_db.learners.get_informed_consent_by_id(learner.consent_id)
-    current_ic = tesla_db.learners.get_current_informed_consent()
-    response['ic_version'] = ic.version
+    consents = get_consent_table()
+    ic_version, ic_valid = consents.get_consent(learner.consent_id)
+    response['ic_version'] = ic_version
     response['accepted_date'] = learner.consent_accepted
     response['rejected_date'] = learner.consent_rejected
-    response['ic_current_version'] = current_ic.version
+    response['ic_current_version'] = consents.current_version
 
     if learner.consent_rejected is not None:
         return response
 
-    ic_version = LooseVersion(ic.version).version
-    current_version = LooseVersion(current_ic.version).version
-
-    if ic_version[0] == current_version[0] and ic_version[1] == current_version[1]:
-        response['ic_valid'] = True
+    response['ic_valid'] = ic_valid
 
     return response
 
 
+class ConsentTable(object):
+    """
+    Informed consent versions and their compatibility with the current informed consent. A consent is compatible
+    when its major and minor versions are the ones of the current consent. There are only a few consent versions, so
+    they are loaded the first time they are requested and kept until the current consent changes.
+    """
+    def __init__(self, current_ic):
+        self.current_id = current_ic.id
+        self.current_version = current_ic.version
+        self.current_key = _get_version_key(current_ic.version)
+        self._versions = {current_ic.id: current_ic.version}
+        self._valid = {current_ic.id: True}
+
+    def get_consent(self, consent_id):
+        """
+        Get the version of an informed consent and if it is compatible with the current one.
+
+        :return: tuple with the version and the compatibility flag
+        """
+        if consent_id not in self._valid:
+            ic = tesla_db.learners.get_informed_consent_by_id(consent_id)
+            version = ic.version
+            self._versions[consent_id] = version
+            self._valid[consent_id] = _get_version_key(version) == self.current_key
+
+        return self._versions[consent_id], self._valid[consent_id]
+
+
+def _get_version_key(version):
+    return tuple(LooseVersion(version).version[:2])
+
+
+def get_consent_table():
+    """
+    Get the informed consent table for the current informed consent
+    """
+    global _consent_table
+
+    table = informed_consent_cache.get('current')
+    if table is None:
+        current_ic = tesla_db.learners.get_current_informed_consent()
+
+        # Versions already loaded remain valid while the current consent does not change
+        table = _consent_table
+        if table is None or (table.current_id, table.current_version) != (current_ic.id, current_ic.version):
+            table = ConsentTable(current_ic)
+        _consent_table = table
+        informed_consent_cache.set('current', table)
+
+    return table
+
+
+def invalidate_consent_table():
+    """
+    Discard the informed consent table. It must be called when the informed consents are modified.
+    """
+    global _consent_table
+
+    informed_consent_cache.clear()
+    _consent_table = None
+
+
 #@cache.memoize(900)
 def get_learner_send_info(tesla_id):
+
+    return get_learner_send_profile(tesla_id).to_json()
+
+
+class SendProfile(namedtuple('SendProfile', ['version', 'is_send', 'disabled_instruments', 'options'])):
+    """
+    SEND information of a learner, merged from all its SEND categories. It is immutable, so it can be shared between
+    requests.
+    """
+    __slots__ = ()
+
+    def to_json(self):
+        return {'is_send': self.is_send,
+                'send': {'options': list(self.options), 'disabled_instruments': list(self.disabled_instruments)}}
+
+
+def get_learner_send_profile(tesla_id):
+    """
+    Get the SEND profile of a learner. Cached profiles are checked again when they expire, and they are only rebuilt
+    if the SEND categories of the learner changed.
+
+    :param tesla_id: learner TeSLA ID
+    :return: SendProfile object
+    """
     # TODO: Remove if TEP is not deployed
-    learner = tep_db.sync_learner(tesla_id)
+    sync.sync_learner(tesla_id)
 
-    send_categories = tesla_db.learners.get_send_user(tesla_id)
-    disabled_instruments = set()
-    options = set()
+    tesla_id = str(tesla_id)
+    profile, fresh = send_profile_cache.peek(tesla_id)
+    if profile is not None and fresh:
+        return profile
 
+    send_categories = tesla_db.learners.get_send_user(tesla_id)
     if send_categories is None:
         send_categories = []
 
-    for c in send_categories:
-        data = decode_data(c.data)
-        c.data = data
+    categories = [(c.id, c.data) for c in send_categories]
+    version = _get_send_version(categories)
+    if profile is None or profile.version != version:
+        profile = _build_send_profile(version, categories)
+    send_profile_cache.set(tesla_id, profile)
+
+    return profile
+
+
+def get_learner_send_profiles(tesla_ids):
+    """
+    Get the SEND profile of several learners, loading all the missing profiles with a single query. Learners are not
+    synchronized with the TEP.
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :return: dictionary with the SendProfile object of each learner
+    """
+    profiles = {}
+    missing = []
+    for tesla_id in set(str(tesla_id) for tesla_id in tesla_ids):
+        profile = send_profile_cache.get(tesla_id)
+        if profile is None:
+            missing.append(tesla_id)
+        else:
+            profiles[tesla_id] = profile
+
+    if len(missing) > 0:
+        categories = dict((tesla_id, []) for tesla_id in missing)
+        for row in queries.get_send_categories(missing):
+            categories[str(row.tesla_id)].append((row.id, row.data))
+
+        for tesla_id, learner_categories in categories.items():
+            profile = _build_send_profile(_get_send_version(learner_categories), learner_categories)
+            send_profile_cache.set(tesla_id, profile)
+            profiles[tesla_id] = profile
+
+    return profiles
+
+
+ActivityInstrument = namedtuple('ActivityInstrument', ['instrument_id', 'required', 'alternative_instrument_id'])
+
+
+class ActivityInstrumentConfig(namedtuple('ActivityInstrumentConfig', ['version', 'instruments'])):
+    """
+    Instruments activated for an activity. The version is a digest of the configuration, so activities with the same
+    configuration share their resolved instruments.
+    """
+    __slots__ = ()
+
+
+def get_activity_instrument_config(activity_id):
+    """
+    Get the instruments activated for an activity
+
+    :param activity_id: activity identifier
+    :return: ActivityInstrumentConfig object
+    """
+    config = activity_instruments_cache.get(activity_id)
+    if config is None:
+        act_instruments = tesla_db.activities.get_activity_instruments(activity_id)
+        if act_instruments is None:
+            act_instruments = []
+
+        instruments = tuple(ActivityInstrument(inst.instrument_id, inst.required, inst.alternative_instrument_id)
+                            for inst in act_instruments)
+        version = hashlib.sha1(repr(instruments).encode('utf-8')).hexdigest()
+        config = ActivityInstrumentConfig(version=version, instruments=instruments)
+        activity_instruments_cache.set(activity_id, config)
+
+    return config
+
+
+def invalidate_activity_instrument_config(activity_id):
+    """
+    Remove the instruments of an activity from the cache. It must be called when they are modified.
+    """
+    activity_instruments_cache.invalidate(activity_id)
+    activity_tesla_active_cache.invalidate(activity_id)
+
+
+def is_activity_tesla_active(activity_id):
+    """
+    Check if TeSLA is active for an activity, that is, if some of its instruments is active
+    """
+    tesla_active = activity_tesla_active_cache.get(activity_id)
+    if tesla_active is None:
+        tesla_active = queries.is_activity_tesla_active(activity_id)
+        activity_tesla_active_cache.set(activity_id, tesla_active)
+
+    return tesla_active
+
+
+def set_activity_tesla_active(activity_id, act_instruments):
+    """
+    Store if TeSLA is active for an activity from its list of instruments
+    """
+    activity_tesla_active_cache.set(activity_id, any(instrument.active is True for instrument in act_instruments))
+
+
+def resolve_learner_instruments(act_config, send_profile):
+    """
+    Get the instruments to activate for a learner, replacing the instruments disabled by its SEND profile with their
+    alternatives when they are not required. The result only depends on the activity configuration and the disabled
+    instruments, so it is cached for each combination.
+
+    :param act_config: ActivityInstrumentConfig object of the activity
+    :param send_profile: SendProfile object of the learner
+    :return: list of instrument identifiers
+    """
+    disabled_instruments = send_profile.disabled_instruments if send_profile.is_send else frozenset()
+    key = (act_config.version, disabled_instruments)
+
+    instruments = instrument_resolution_cache.get(key)
+    if instruments is None:
+        instruments = tuple(_resolve_instruments(act_config.instruments, disabled_instruments))
+        instrument_resolution_cache.set(key, instruments)
+
+    return list(instruments)
+
+
+def _resolve_instruments(act_instruments, disabled_instruments):
+    for inst in act_instruments:
+        if inst.instrument_id in disabled_instruments:
+            if not inst.required:
+                if inst.alternative_instrument_id is not None and inst.alternative_instrument_id not in \
+                        disabled_instruments:
+                    yield inst.alternative_instrument_id
+        else:
+            yield inst.instrument_id
+
+
+def invalidate_send_profile(tesla_id):
+    """
+    Remove the SEND profile of a learner from the cache. It must be called when its SEND categories are modified.
+    """
+    send_profile_cache.invalidate(str(tesla_id))
+
+
+def _get_send_version(categories):
+    digest = hashlib.sha1()
+    for category_id, data in sorted(categories, key=lambda category: category[0]):
+        digest.update(repr((category_id, data)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _build_send_profile(version, categories):
+    disabled_instruments = set()
+    options = set()
+
+    for category_id, data in categories:
+        data = decode_data(data)
         disabled_instruments.update(data['instruments'])
         options.update(data['options'])
 
-    return {'is_send': len(send_categories)>0,
-            'send': {'options': list(options), 'disabled_instruments': list(disabled_instruments)}}
+    return SendProfile(version=version, is_send=len(categories) > 0,
+                       disabled_instruments=frozenset(disabled_instruments), options=frozenset(options))
 
 
-#@cache.memoize(900)
 def get_cert_module(cert):
 
     if cert is None:
         return None
 
+    key = hashlib.sha256(cert.encode('utf-8')).hexdigest()
+    module = cert_module_cache.get(key)
+    if module is None:
+        module = cert_module_flight.do(key, _load_cert_module, cert)
+        cert_module_cache.set(key, module)
+
+    return _copy_module(module)
+
+
+def get_cert_module_from_identity(cn, fingerprint=None):
+    """
+    Get the module for a client certificate already verified by nginx, without loading the certificate.
+
+    :param cn: common name of the certificate subject
+    :param fingerprint: SHA1 fingerprint of the certificate, used as cache key when provided
+    """
+    if fingerprint:
+        key = 'fp:' + fingerprint.lower()
+    else:
+        key = 'cn:' + cn.upper()
+
+    module = cert_module_cache.get(key)
+    if module is None:
+        module = cert_module_flight.do(key, _get_cn_module, cn)
+        cert_module_cache.set(key, module)
+
+    return _copy_module(module)
+
+
+def get_cert_cn(cert):
+
     cert = cert + '\n'
     cert = cert.replace('\n\t', '\n')
 
     cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
 
-    subject = cert.get_subject().CN.upper()
+    return cert.get_subject().CN
+
+
+def _load_cert_module(cert):
+    return _get_cn_module(get_cert_cn(cert))
+
+
+def _get_cn_module(cn):
+
+    subject = cn.upper()
     acronym = subject.split('.')[0]
-    print(tesla_db.db)
-    instrument = tesla_db.instruments.get_instrument_by_acronym(acronym)
-    is_instrument = False
-    if instrument is not None:
-        is_instrument = True
-        instrument = instrument_schema.dump(instrument)[0]
+    instrument = catalog.get_instrument_module(acronym)
+    is_instrument = instrument is not None
 
     return {'is_instrument': is_instrument, 'acronym': acronym, 'instrument': instrument}
 
 
+def _copy_module(module):
+    # Cached modules are shared between requests, so callers receive their own copy
+    module = dict(module)
+    if module['instrument'] is not None:
+        module['instrument'] = dict(module['instrument'])
+
+    return module
+
+
+def invalidate_cert_modules(acronym=None):
+    """
+    Remove resolved certificate modules from the cache. It must be called when an instrument is modified.
+
+    :param acronym: acronym of the modified instrument. If not provided, all the modules are removed.
+    """
+    if acronym is None:
+        cert_module_cache.clear()
+    else:
+        cert_module_cache.invalidate_if(lambda module: module['acronym'] == acronym.upper())
+
+
+# Resolved modules contain instrument data, so they are discarded when the instrument catalog changes
+catalog.on_reload(invalidate_cert_modules)
+
+
 def get_cert_module_debug(cert):
 
     from flask import request
@@ -141,11 +484,8 @@ def get_cert_module_debug(cert):
     if debug_cn:
         subject = debug_cn.upper()
         acronym = subject.split('-')[0]
-        instrument = tesla_db.instruments.get_instrument_by_acronym(acronym)
-        is_instrument = False
-        if instrument is not None:
-            is_instrument = True
-            instrument = instrument_schema.dump(instrument)[0]
+        instrument = catalog.get_instrument_module(acronym)
+        is_instrument = instrument is not None
 
         return {'is_instrument': is_instrument, 'acronym': acronym, 'instrument': instrument}
 
@@ -153,8 +493,280 @@ def get_cert_module_debug(cert):
 
 
 #@cache.memoize(900)
+def get_enrolment_phase(percentage, completed, pending):
+    """
+    Get the enrolment phase of a learner for an instrument
+
+    :param percentage: enrolment percentage, or None if the learner has no enrolment for the instrument
+    :param completed: number of completed enrolment requests
+    :param pending: number of pending enrolment requests
+    """
+    if percentage is None:
+        if completed > 0 or pending > 0:
+            return TESLA_ENROLLMENT_PHASE.ONGOING
+        return TESLA_ENROLLMENT_PHASE.NOT_STARTED
+
+    if percentage == 1.0:
+        return TESLA_ENROLLMENT_PHASE.COMPLETED
+
+    return TESLA_ENROLLMENT_PHASE.ONGOING
+
+
+def get_enrolment_matrix(tesla_ids, instrument_ids):
+    """
+    Get the enrolment phase and completion of several learners for several instruments, using one grouped query for
+    the enrolments and another one for the enrolment requests.
+
+    :param tesla_ids: list of learner TeSLA IDs
+    :param instrument_ids: list of instrument identifiers
+    :return: list with the tesla_id and the enrolment of each instrument for each learner, in the given order
+    """
+    if len(tesla_ids) == 0 or len(instrument_ids) == 0:
+        return [{'tesla_id': tesla_id, 'instruments': {}} for tesla_id in tesla_ids]
+
+    percentages = dict(((str(row.tesla_id), row.instrument_id), row.percentage)
+                       for row in queries.get_learners_enrolment_percentages(tesla_ids, instrument_ids))
+    counts = dict(((str(row.tesla_id), row.instrument_id), (int(row.completed), int(row.pending)))
+                  for row in queries.get_learners_enrolment_request_counts(tesla_ids, instrument_ids))
+
+    matrix = []
+    for tesla_id in tesla_ids:
+        instruments = {}
+        for instrument_id in instrument_ids:
+            percentage = percentages.get((tesla_id, instrument_id))
+            completed, pending = counts.get((tesla_id, instrument_id), (0, 0))
+            instruments[str(instrument_id)] = {
+                'enrolment_phase_id': get_enrolment_phase(percentage, completed, pending),
+                'enrolment_completion': percentage if percentage is not None else 0.0
+            }
+        matrix.append({'tesla_id': tesla_id, 'instruments': instruments})
+
+    return matrix
+
+
+def make_etag(*parts):
+    """
+    Build a strong ETag from a version stamp or the content of a resource
+    """
+    data = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def etag_response(etag, build_response):
+    """
+    Build the response serving a resource with its ETag. ETags are computed on each request from the database
+    state, so every worker process agrees on them. If the ETag matches the conditional request, a 304 response is
+    returned instead and the response is not built.
+
+    :param etag: ETag of the resource
+    :param build_response: function returning the response serving the resource
+    """
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+
+    response = make_response(build_response())
+    response.set_etag(etag)
+
+    return response
+
+
+def not_modified_response(etag):
+    """
+    Get the 304 response of a conditional request matching an ETag. It is used to answer conditional requests before
+    the resource is synchronized or read.
+
+    :param etag: ETag of the resource, or None if it is unknown
+    :return: 304 response, or None if the resource must be served
+    """
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+
+    return _not_modified(etag)
+
+
+def get_activity_etag(resource, vle_id, activity_type, activity_id, *parts):
+    """
+    Build the ETag of an activity resource from the version stamp of the activity, without reading the activity.
+
+    :param resource: name of the resource
+    :param vle_id: VLE identifier
+    :param activity_type: type of the activity in the VLE
+    :param activity_id: identifier of the activity in the VLE
+    :param parts: other version stamps the resource depends on
+    :return: ETag, or None if the activity does not exist
+    """
+    stamp = queries.get_activity_stamp(vle_id, activity_type, activity_id)
+    if stamp is None:
+        return None
+
+    return make_etag(resource, stamp, *parts)
+
+
+def _not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+
+    return response
+
+
+def get_activity_results_version(activity_id):
+    """
+    Get the version of the results of an activity. It is read from the database, so it changes each time a result of
+    the activity is written, by this service or any other. When the activity reports are enabled, it is the version
+    kept by their trigger, read with a single lookup. Otherwise, all the results of the activity are read.
+    """
+    if activity_reports.ACTIVITY_REPORTS:
+        return activity_reports.get_activity_results_version(activity_id)
+
+    return queries.get_activity_results_version(activity_id)
+
+
+def get_activity_context(activity_id, version=None):
+    """
+    Get the instruments with requests in an activity and the histogram of the activity results for each of them. They
+    are cached in the application cache for a version of the activity results, so a cached context is never used once
+    the results change. With a per-process cache backend, each process computes its own copy.
+
+    :param activity_id: activity identifier
+    :param version: version of the activity results, as returned by get_activity_results_version. If not provided,
+        the current version is read.
+    :return: dictionary with the list of instrument identifiers and the histogram of each instrument
+    """
+    if version is None:
+        version = get_activity_results_version(activity_id)
+
+    key = 'tesla_activity_context_{}_{}'.format(activity_id, version)
+    context = cache.get(key)
+    if context is None:
+        activity_instruments = tesla_db.reports.get_activity_instruments_with_requests(activity_id)
+        context = {'instrument_ids': [instrument.id for instrument in activity_instruments],
+                   'histograms': {}}
+        for instrument in activity_instruments:
+            context['histograms'][instrument.id] = list(
+                tesla_db.statistics.verification_activity_results_histogram(activity_id, instrument.id))
+        cache.set(key, context, timeout=REPORT_CONTEXT_CACHE_TTL)
+
+    return context
+
+
+def get_per_page(request, default=20):
+    """
+    Get the page size from the per_page query parameter, limited to MAX_PER_PAGE
+    """
+    try:
+        per_page = int(request.args.get('per_page', default))
+    except ValueError:
+        per_page = default
+
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+def encode_cursor(tesla_id, level=None):
+    """
+    Build an opaque pagination cursor pointing after the given learner. When learners are sorted by their worst level,
+    the level of the learner is also included.
+    """
+    data = {'tesla_id': str(tesla_id)}
+    if level is not None:
+        data['level'] = level
+    data = json.dumps(data).encode('utf-8')
+
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Get the learner a pagination cursor points after. An empty cursor points to the first page.
+
+    :return: TeSLA ID, or None for the first page
+    :raises ValueError: if the cursor is not valid
+    """
+    if not cursor:
+        return None
+
+    try:
+        cursor = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return str(uuid.UUID(data['tesla_id']))
+    except (TypeError, KeyError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def decode_level_cursor(cursor):
+    """
+    Get the learner and level a pagination cursor of learners sorted by their worst level points after.
+
+    :return: tuple with the level and the TeSLA ID, or None for the first page
+    :raises ValueError: if the cursor is not valid
+    """
+    if not cursor:
+        return None
+
+    try:
+        cursor = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return int(data['level']), str(uuid.UUID(data['tesla_id']))
+    except (TypeError, KeyError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def get_learners_page(activity_id, cursor, per_page, instrument_ids=None):
+    """
+    Get a page of the learners with requests in an activity using keyset pagination
+
+    :param instrument_ids: list of instrument identifiers. Only learners with requests for some of them are returned.
+    :return: tuple with the list of TeSLA IDs and the cursor of the next page, or None if it is the last page
+    """
+    tesla_ids = queries.get_activity_learners_after(activity_id, decode_cursor(cursor), per_page + 1,
+                                                    instrument_ids=instrument_ids)
+    next_cursor = None
+    if len(tesla_ids) > per_page:
+        tesla_ids = tesla_ids[:per_page]
+        next_cursor = encode_cursor(tesla_ids[-1])
+
+    return tesla_ids, next_cursor
+
+
+def get_learners_page_items(tesla_ids):
+    """
+    Get the items of a page of learners obtained with keyset pagination. Items have the same fields as the items of
+    schemas.ActivitySummaryPagination, so both kinds of pagination return the same learner data.
+
+    :param tesla_ids: list of learner TeSLA IDs, in the page order
+    :return: list of serialized learners, in the same order
+    """
+    learners = dict((str(row.tesla_id), row) for row in queries.get_learner_rows(tesla_ids))
+    item_schema = schemas.ActivitySummaryPagination().fields['items'].schema.__class__(many=True)
+
+    return item_schema.dump([learners[str(tesla_id)] for tesla_id in tesla_ids]).data
+
+
+def get_learners_page_by_level(activity_id, cursor, per_page, instrument_ids=None, min_levels=None, max_levels=None,
+                               worst_first=False):
+    """
+    Get a page of the learners of an activity filtered and sorted by their stored levels, using keyset pagination.
+
+    :return: tuple with the list of TeSLA IDs and the cursor of the next page, or None if it is the last page
+    :raises ValueError: if the cursor is not valid
+    """
+    after = decode_level_cursor(cursor) if worst_first else decode_cursor(cursor)
+    learners = activity_reports.get_activity_learners_by_level(activity_id, instrument_ids=instrument_ids,
+                                                               min_levels=min_levels, max_levels=max_levels,
+                                                               worst_first=worst_first, after=after,
+                                                               limit=per_page + 1)
+    next_cursor = None
+    if len(learners) > per_page:
+        learners = learners[:per_page]
+        tesla_id, worst_level = learners[-1]
+        next_cursor = encode_cursor(tesla_id, level=worst_level if worst_first else None)
+
+    return [tesla_id for tesla_id, _ in learners], next_cursor
+
+
 def get_learner_enrolments(tesla_id):
     # TODO: Remove if TEP is not deployed
-    tep_db.sync_learner(tesla_id)
+    sync.sync_learner(tesla_id)
 
     return tesla_db.learners.get_learner_enrolments(tesla_id)